@@ -0,0 +1,115 @@
+"""Подбор размера батча при загрузке.
+Один и тот же размер батча плох и для файла из 30 столбцов, и для файла из 5, и для локальной БД,
+и для удаленной. AdaptiveBatchSize меряет время каждого executemany и двигает размер так,
+чтобы батч занимал около TARGET_SECONDS: быстрые батчи растут, медленные уменьшаются.
+Размер ограничен сверху так, чтобы оценка длины запроса оставалась меньше max_allowed_packet сервера.
+Выбранные размеры по файлу печатаются после его загрузки.
+Подобранный размер не теряется между файлами: у каждого треда (а значит, и у его соединения)
+свой AdaptiveBatchSize (get_sizer), и следующий файл начинает с размера, на котором остановился прошлый.
+Пул тредов загрузки (uploader.py) держит один AdaptiveBatchSize на все треды: батчи режет парсер,
+а время загрузки сообщают треды.
+"""
+import logging
+import threading
+
+# начальный размер батча
+BATCH_SIZE = 500
+# сколько должен занимать один батч
+TARGET_SECONDS = 0.5
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 50000
+# во сколько раз размер может измениться за один батч
+MAX_STEP = 2.0
+# какую долю max_allowed_packet может занимать запрос
+PACKET_USAGE = 0.8
+# по скольким строкам оцениваем длину строки в запросе
+SAMPLE_ROWS = 200
+
+_max_allowed_packet = None
+_local = threading.local()
+
+
+def max_allowed_packet(cur):
+    """max_allowed_packet сервера, спрашиваем один раз на процесс"""
+    global _max_allowed_packet
+    if _max_allowed_packet is None:
+        cur.execute("SELECT @@max_allowed_packet AS packet")
+        row = cur.fetchone()
+        _max_allowed_packet = int(row['packet'] if isinstance(row, dict) else row[0])
+        logging.info(f'MAX_ALLOWED_PACKET: {_max_allowed_packet}')
+    return _max_allowed_packet
+
+
+def estimate_row_bytes(df):
+    """длина самой длинной строки выборки в тексте INSERT: значения в utf-8 плюс кавычки и запятые"""
+    sample = df.head(SAMPLE_ROWS).astype(object)
+    if not len(sample):
+        return 0
+    lengths = [sum(len(str(value).encode('utf-8')) + 4 for value in row)
+               for row in sample.itertuples(index=False)]
+    return max(lengths) + 2
+
+
+class AdaptiveBatchSize:
+    def __init__(self, max_packet=None, row_bytes=0, start=BATCH_SIZE, target_seconds=TARGET_SECONDS,
+                 min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        # верхняя граница без учета max_allowed_packet
+        self.size_limit = max_size
+        self.max_size = max_size
+        self.max_packet = max_packet
+        self.size = start
+        self.fit(row_bytes)
+        self.sizes = []
+        self.rows = 0
+        self.seconds = 0.0
+
+    def fit(self, row_bytes, max_packet=None):
+        """ограничивает размер батча по длине строки очередного датафрейма,
+        чтобы запрос помещался в max_allowed_packet; подобранный размер сохраняется"""
+        if max_packet:
+            self.max_packet = max_packet
+        self.max_size = self.size_limit
+        if self.max_packet and row_bytes:
+            self.max_size = max(self.min_size, min(self.size_limit, int(self.max_packet * PACKET_USAGE // row_bytes)))
+        self.size = self._clamp(self.size)
+        return self
+
+    def _clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def next_size(self):
+        return self.size
+
+    def record(self, rows, seconds):
+        """время загрузки батча из rows строк: следующий батч подгоняем под target_seconds"""
+        self.sizes.append(rows)
+        self.rows += rows
+        self.seconds += seconds
+        # неполный последний батч ничего не говорит о размере
+        if rows < self.size or seconds <= 0:
+            return
+        step = max(1 / MAX_STEP, min(MAX_STEP, self.target_seconds / seconds))
+        self.size = self._clamp(self.size * step)
+
+    def report(self, name):
+        if not self.sizes:
+            return
+        rate = self.rows / self.seconds if self.seconds else 0.0
+        text = (f'{name}: {len(self.sizes)} batches, size {min(self.sizes)}..{max(self.sizes)} '
+                f'(last {self.sizes[-1]}, limit {self.max_size}), {rate:.0f} rows/s')
+        logging.info(f'BATCH SIZES {text}')
+        print(f'Batch sizes {text}')
+        # следующий отчет - только по следующему файлу
+        self.sizes = []
+        self.rows = 0
+        self.seconds = 0.0
+
+
+def get_sizer(cur):
+    """AdaptiveBatchSize текущего треда: загрузки одного треда идут через одно соединение подряд"""
+    sizer = getattr(_local, 'sizer', None)
+    if sizer is None:
+        sizer = _local.sizer = AdaptiveBatchSize(max_allowed_packet(cur))
+    return sizer
@@ -0,0 +1,362 @@
+"""Бенчмарк парсера и загрузки на синтетических файлах.
+Генерирует дерево папок филиалов с xlsx (и xls, если установлен xlwt) и fields.csv,
+в файлах есть все особенности, с которыми справляется парсер: пустые строки и заголовок отчета
+над таблицей, шапка из двух строк, строка нумерации столбцов, строки "Итого", числа с запятой
+и пробелами, пустые коды классов (автозаполнение), столбец дат и филиал с альтернативной конфигурацией (//add).
+Замеряется время каждого этапа GpXlsParser.parse, потокового парсинга и путей загрузки
+(executemany в sqlite в памяти вместо MySQL, запись TSV для LOAD DATA).
+С --engines дополнительно замеряется чтение каждого файла всеми установленными движками (reader.py),
+секунды на мегабайт по форматам сохраняются в reader.ENGINE_TIMINGS_FILE, и парсер выбирает по ним
+самый быстрый движок. Заодно проверяется, что все движки читают файл так же, как pd.read_excel
+(расхождения попадают в engine_mismatches). Лучше запускать на настоящих файлах филиалов
+(--workdir с деревом и fields.csv не генерируется, если указан --real).
+Результат - JSON, чтобы сравнивать версии между собой.
+
+    python benchmark.py --rows 20000 --files 2 --out bench.json
+    python benchmark.py --engines --real --workdir /path/to/startdir
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import pandas as pd
+
+from config import GpXlsConfig, config_file, NEW_STRING_SEPARATOR, bkf_table
+from reader import ENGINE_PREFERENCE, ENGINE_TIMINGS_FILE, engine_available, file_format, read_raw
+from xlsparser import GpXlsParser
+
+# этапы GpXlsParser.parse, время которых меряем
+PARSE_STAGES = [
+    '_read_raw', '_detect_header', '_check_first_string', '_clear_df', '_set_index',
+    '_init_df_types', '_df_autofill', '_compact_df_types', '_mapped_df', '_validate_df', '_add_service_fields',
+]
+
+MAIN_BRANCH = 'Филиал А'
+ALTER_BRANCH = 'Филиал Б'
+
+# поле: (тип, описание, имя в основной конфигурации, имя в альтернативной)
+FIELDS = {
+    'bkf_inv_num': ('varchar(50)', 'Инвентарный номер', 'Инвентарный номер', 'Инвентарный номер'),
+    'bkf_os_name': ('varchar(255)', 'Наименование', 'Наименование', 'Наименование ОС'),
+    'bkf_class_os_code': ('varchar(20)', 'Код класса ОС', 'Код класса', 'Класс ОС'),
+    'bkf_business_sphere': ('varchar(100)', 'Сфера деятельности', 'Сфера деятельности', 'Сфера'),
+    'bkf_init_cost': ('decimal(15,2)', 'Первоначальная стоимость',
+                      'Стоимость$$первоначальная', 'Стоимость$$первоначальная'),
+    'bkf_rest_cost': ('decimal(15,2)', 'Остаточная стоимость',
+                      'Стоимость$$остаточная', 'Стоимость$$остаточная'),
+    'bkf_start_date': ('date', 'Дата ввода в эксплуатацию', 'Дата ввода', 'Дата ввода в эксплуатацию'),
+}
+
+
+def write_fields_csv(startdir):
+    rows = []
+    for field, (type_, desc, main_name, alter_name) in FIELDS.items():
+        rows.append({'FIELD': field, 'TYPE': type_, 'DESCRIPTION': desc,
+                     MAIN_BRANCH: main_name, ALTER_BRANCH: main_name,
+                     ALTER_BRANCH + '//add': alter_name})
+    pd.DataFrame(rows).to_csv(os.path.join(startdir, config_file), sep=';', index=False, encoding='cp1251')
+
+
+def _header_rows(names):
+    """две строки шапки: общие заголовки и подзаголовки для полей вида 'Стоимость$$остаточная'"""
+    top, bottom = [], []
+    previous = None
+    for name in names:
+        parts = name.split(NEW_STRING_SEPARATOR)
+        if len(parts) == 2:
+            # объединенная ячейка: общий заголовок пишется только над первым столбцом
+            top.append(parts[0] if parts[0] != previous else None)
+            bottom.append(parts[1])
+            previous = parts[0]
+        else:
+            top.append(name)
+            bottom.append(None)
+            previous = None
+    return top, bottom
+
+
+def _money(value, comma):
+    text = f'{value:,.2f}'.replace(',', ' ')
+    return text.replace('.', ',') if comma else text
+
+
+def generate_rows(names, rows, rnd: random.Random, comma_decimals):
+    """строки файла целиком: шапка отчета, шапка таблицы, нумерация и данные с мусором"""
+    top, bottom = _header_rows(names)
+    yield []
+    yield []
+    yield ['Инвентарная книга основных средств']
+    yield []
+    yield top
+    yield bottom
+    yield [str(i + 1) for i in range(len(names))]
+    spheres = ['Добыча', 'Транспорт', 'Хранение', 'Прочее']
+    for i in range(rows):
+        if i and i % 500 == 0:
+            yield [None, 'Итого'] + [None] * (len(names) - 2)
+        cls = f'{rnd.randint(10, 99)}.{rnd.randint(1, 9)}' if i % 7 == 0 else None
+        sphere = rnd.choice(spheres) if i % 11 == 0 else None
+        init = rnd.uniform(1000, 5000000)
+        start = datetime.datetime(1990, 1, 1) + datetime.timedelta(days=rnd.randint(0, 12000))
+        yield [f'{100000 + i}', f'Объект основных средств {i}', cls, sphere,
+               _money(init, comma_decimals), _money(init * rnd.random(), comma_decimals), start]
+    yield [None, 'Итого'] + [None] * (len(names) - 2)
+
+
+def write_xlsx(path, rows):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+
+def write_xls(path, rows):
+    import xlwt
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet('Лист1')
+    # в xls дата - число с форматом даты
+    date_style = xlwt.easyxf(num_format_str='DD.MM.YYYY')
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            if isinstance(value, datetime.datetime):
+                ws.write(i, j, value, date_style)
+            elif value is not None:
+                ws.write(i, j, value)
+    wb.save(path)
+
+
+def generate_tree(startdir, rows, files, formats, seed=0):
+    """создает дерево startdir/филиал/файлы и fields.csv, возвращает список файлов"""
+    rnd = random.Random(seed)
+    write_fields_csv(startdir)
+    writers = {'xlsx': write_xlsx, 'xls': write_xls}
+    filenames = []
+    for branch in (MAIN_BRANCH, ALTER_BRANCH):
+        os.makedirs(os.path.join(startdir, branch), exist_ok=True)
+        # у второго филиала файлы в альтернативной раскладке, с запятой в числах
+        column = 3 if branch == ALTER_BRANCH else 2
+        names = [v[column] for v in FIELDS.values()]
+        for n in range(files):
+            for fmt in formats:
+                # в xls не больше 65536 строк
+                file_rows = min(rows, 60000) if fmt == 'xls' else rows
+                path = os.path.join(startdir, branch, f'book_{n}.{fmt}')
+                writers[fmt](path, generate_rows(names, file_rows, rnd, branch == ALTER_BRANCH))
+                filenames.append(path)
+    return filenames
+
+
+def offline_config(startdir):
+    return GpXlsConfig(startdir, branches_indexes={MAIN_BRANCH: 1, ALTER_BRANCH: 2})
+
+
+def time_parse(file, config):
+    """время каждого этапа parse: методы парсера оборачиваются таймерами"""
+    parser = GpXlsParser(file, config)
+    stages = {}
+    for name in PARSE_STAGES:
+        method = getattr(parser, name)
+
+        def timed(*args, _method=method, _name=name, **kwargs):
+            t1 = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                stages[_name] = stages.get(_name, 0.0) + time.perf_counter() - t1
+        setattr(parser, name, timed)
+    t1 = time.perf_counter()
+    df = parser.parse()
+    total = time.perf_counter() - t1
+    return df, {'stages': stages, 'total': total, 'rows': len(df)}
+
+
+def time_parse_chunks(file, config, chunk_size=10000):
+    t1 = time.perf_counter()
+    rows = sum(len(df) for df in GpXlsParser(file, config).parse_chunks(chunk_size))
+    return {'total': time.perf_counter() - t1, 'rows': rows}
+
+
+class StandInCursor:
+    """sqlite в памяти вместо MySQL: переводит %s в ? для executemany"""
+    def __init__(self, conn):
+        self.cur = conn.cursor()
+
+    def executemany(self, SQL, batch):
+        self.cur.executemany(SQL.replace('%s', '?'), batch)
+
+
+def time_uploads(df: pd.DataFrame, batch_size=500):
+    from bulk import write_tsv
+    from main import encode_batches, insert_sql, upload_batch
+    result = {}
+    conn = sqlite3.connect(':memory:')
+    conn.execute(f"CREATE TABLE {bkf_table} ({', '.join(df.columns)})")
+    cur = StandInCursor(conn)
+    SQL = insert_sql(df)
+    columns = list(df.columns)
+    t1 = time.perf_counter()
+    batches = list(encode_batches(df, batch_size))
+    result['encode_batches'] = time.perf_counter() - t1
+    t1 = time.perf_counter()
+    for batch in batches:
+        upload_batch(SQL, columns, batch, cur, conn)
+    result['executemany_sqlite'] = time.perf_counter() - t1
+    conn.close()
+    with tempfile.TemporaryFile('w', encoding='utf-8') as f:
+        t1 = time.perf_counter()
+        write_tsv(df, f)
+        result['infile_write_tsv'] = time.perf_counter() - t1
+    return result
+
+
+def _cell_values(df: pd.DataFrame):
+    """значения без учета dtype: pandas 3 отдает строки в dtype str с NaN, движки reader.py - object с None"""
+    return df.astype(object).where(df.notnull(), None)
+
+
+def time_engines(file, repeat=2):
+    """лучшее из repeat время чтения файла каждым установленным движком и список движков,
+    прочитавших файл не так, как pandas"""
+    result, frames = {}, {}
+    for engine in ENGINE_PREFERENCE[file_format(file)]:
+        if not engine_available(engine):
+            continue
+        best = None
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            frames[engine] = read_raw(file, engine)
+            seconds = time.perf_counter() - t1
+            best = seconds if best is None else min(best, seconds)
+        result[engine] = best
+    reference = frames.get('pandas')
+    if reference is not None:
+        reference = _cell_values(reference)
+    mismatches = [engine for engine, df in frames.items()
+                  if reference is not None and not _cell_values(df).equals(reference)]
+    if mismatches:
+        logging.warning(f'{file}: {", ".join(mismatches)} READ IT DIFFERENTLY FROM pd.read_excel')
+    return result, mismatches
+
+
+def engine_timings(results):
+    """секунды на мегабайт по формату и движку, по всем файлам прогона"""
+    totals = {}
+    for r in results:
+        fmt = totals.setdefault(r['format_group'], {})
+        for engine, seconds in r['engines'].items():
+            stats = fmt.setdefault(engine, [0.0, 0])
+            stats[0] += seconds
+            stats[1] += r['size']
+    return {fmt: {engine: seconds / (size / 2 ** 20) for engine, (seconds, size) in engines.items()}
+            for fmt, engines in totals.items()}
+
+
+def save_engine_timings(timings, path=ENGINE_TIMINGS_FILE):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'revision': git_revision(), 'created': time.time(), 'seconds_per_mb': timings},
+                  f, ensure_ascii=False, indent=1)
+
+
+def run_engines(workdir):
+    """замер движков на всех xls файлах дерева workdir"""
+    from planner import iter_work
+    results = []
+    for item in iter_work(workdir):
+        engines, mismatches = time_engines(item.path)
+        print(os.path.relpath(item.path, workdir), {e: round(t, 3) for e, t in engines.items()})
+        results.append({'file': os.path.relpath(item.path, workdir), 'size': item.size,
+                        'format_group': file_format(item.path), 'engines': engines, 'mismatches': mismatches})
+    return results
+
+
+def engine_mismatches(results):
+    """{файл: движки, прочитавшие его не так, как pandas}"""
+    return {r['file']: r['mismatches'] for r in results if r['mismatches']}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows, files, formats, workdir=None, engines=False):
+    workdir = workdir or tempfile.mkdtemp(prefix='xlsbench_')
+    os.makedirs(workdir, exist_ok=True)
+    filenames = generate_tree(workdir, rows, files, formats)
+    config = offline_config(workdir)
+    results = []
+    for file in filenames:
+        df, parse_stats = time_parse(file, config)
+        results.append({
+            'file': os.path.relpath(file, workdir),
+            'format': os.path.splitext(file)[1][1:],
+            'size': os.path.getsize(file),
+            'parse': parse_stats,
+            'parse_chunks': time_parse_chunks(file, config),
+            'upload': time_uploads(df),
+        })
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'rows': rows,
+        'workdir': workdir,
+        'results': results,
+    }
+    if engines:
+        engine_results = run_engines(workdir)
+        report['engines'] = engine_timings(engine_results)
+        report['engine_mismatches'] = engine_mismatches(engine_results)
+    return report
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--rows', type=int, default=20000, help='строк данных в файле')
+    arg_parser.add_argument('--files', type=int, default=1, help='файлов на филиал и формат')
+    arg_parser.add_argument('--formats', nargs='+', default=['xlsx', 'xls'], choices=['xlsx', 'xls'])
+    arg_parser.add_argument('--workdir', help='куда генерировать файлы (по умолчанию - временная папка)')
+    arg_parser.add_argument('--out', help='файл для результата в JSON (по умолчанию - stdout)')
+    arg_parser.add_argument('--engines', action='store_true',
+                            help=f'замерить движки чтения и сохранить замеры в {ENGINE_TIMINGS_FILE}')
+    arg_parser.add_argument('--real', action='store_true',
+                            help='только замер движков на готовом дереве файлов из --workdir, без генерации')
+    args = arg_parser.parse_args()
+    if args.real:
+        if not args.workdir:
+            arg_parser.error('--real needs --workdir')
+        engine_results = run_engines(args.workdir)
+        timings = engine_timings(engine_results)
+        save_engine_timings(timings)
+        print(json.dumps({'engines': timings, 'engine_mismatches': engine_mismatches(engine_results)},
+                         ensure_ascii=False, indent=1))
+        raise SystemExit
+    formats = args.formats
+    if 'xls' in formats:
+        try:
+            import xlwt  # noqa: F401
+        except ImportError:
+            print('xlwt is not installed, skipping xls')
+            formats = [f for f in formats if f != 'xls']
+    report = run(args.rows, args.files, formats, args.workdir, args.engines)
+    if args.engines:
+        save_engine_timings(report['engines'])
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
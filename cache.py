@@ -0,0 +1,95 @@
+"""Кэш результатов парсинга на диске.
+Ключ - хэш содержимого файла, имя файла, отпечаток настроек филиала из fields.csv и движок чтения
+(reader.pick_engine), поэтому при изменении файла, его колонки в конфиге или движка кэш просто не находится.
+Датафреймы хранятся в parquet, при превышении размера кэша удаляются давно не использованные.
+"""
+import hashlib
+import logging
+import os
+
+import pandas as pd
+
+from reader import pick_engine
+from xlsparser import GpXlsParser
+
+CACHE_DIR = '.parse_cache'
+CACHE_MAX_SIZE = 2 * 1024 ** 3  # 2 Гб
+# увеличиваем, если меняется логика парсера, чтобы старый кэш не использовался
+CACHE_VERSION = 3
+
+
+def file_digest(path, block_size=1024 ** 2):
+    """sha1 содержимого файла, читаем блоками чтобы не грузить файл в память"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    def __init__(self, cachedir=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, file, config):
+        # разные движки по-разному отдают даты и дробные числа, кадр другого движка не подходит
+        engine = pick_engine(file, config.get_config(file).get('reader_engine'))
+        data = f'{CACHE_VERSION}:{file_digest(file)}:{os.path.basename(file)}:{config.fingerprint(file)}:{engine}'
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + '.parquet')
+
+    def get(self, key):
+        """датафрейм из кэша или None. время изменения файла обновляем - по нему работает LRU"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path)
+        return pd.read_parquet(path)
+
+    def put(self, key, df):
+        df.to_parquet(self._path(key))
+        self.evict()
+
+    def evict(self):
+        """удаляем самые давно использованные файлы, пока кэш не влезет в max_size"""
+        entries = [e for e in os.scandir(self.cachedir) if e.name.endswith('.parquet')]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        size = sum(e.stat().st_size for e in entries)
+        while entries and size > self.max_size:
+            entry = entries.pop(0)
+            size -= entry.stat().st_size
+            logging.info(f'CACHE: EVICTING {entry.name}')
+            os.remove(entry.path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def show_stats(self):
+        stats = self.stats()
+        print(f"Parse cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"hit rate {stats['hit_rate']:.0%}")
+
+
+def parse_cached(file, config, cache: ParseCache, layouts=None):
+    """парсит файл, если его нет в кэше, иначе берет готовый датафрейм из кэша"""
+    key = cache.key(file, config)
+    df = cache.get(key)
+    if df is not None:
+        print(f'Parsing {os.path.basename(file)}... (from cache)')
+        return df
+    df = GpXlsParser(file, config, layouts).parse()
+    cache.put(key, df)
+    return df
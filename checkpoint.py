@@ -0,0 +1,197 @@
+"""Загрузка с журналом для продолжения после сбоя.
+В журнал пишется каждый начатый файл, каждый закоммиченный батч и каждый загруженный файл.
+Журнал - таблица bkf_checkpoint_table (запись о батче коммитится вместе с ним, в той же транзакции)
+или локальный файл JSON lines, если в БД его держать нельзя (отладочная или подменная БД).
+С --resume таблицы не пересоздаются: загруженные файлы пропускаются, а у файла, на котором
+упал прошлый прогон, удаляются только его строки (bkf_id больше запомненного перед его загрузкой),
+и он загружается заново. Так после обрыва соединения повторяется один файл, а не весь прогон.
+
+    python checkpoint.py [--resume] [--journal=file.jsonl]
+"""
+import json
+import logging
+import os
+import time
+
+import MySQLdb
+
+from config import GpXlsConfig, startdir, bkf_table, bkf_checkpoint_table
+from db import open_db, close_db
+from main import get_filenames, upload_df_to_db, show_1265_warnings
+from reconcile import FileChecksum, store_checksum
+from xlsparser import GpXlsParser
+
+JOURNAL_FILE = '.checkpoint.jsonl'
+
+
+def max_bkf_id(cur):
+    cur.execute(f"""SELECT MAX(bkf_id) AS max_id FROM {bkf_table}""")
+    return cur.fetchone()['max_id'] or 0
+
+
+def delete_partial_rows(cur, entry):
+    """строки недогруженного файла: его филиал и имя, и bkf_id после начала его загрузки"""
+    cur.execute(f"""DELETE FROM {bkf_table}
+                    WHERE bkf_id > %s AND bkf_branch_id = %s AND bkf_filename = %s""",
+                (entry['start_id'], entry['branch_id'], entry['filename']))
+    return cur.rowcount
+
+
+class DbJournal:
+    """журнал в таблице bkf_checkpoint_table. Записи о батчах не коммитятся сами:
+    они уходят в БД одним коммитом с батчем"""
+    def __init__(self, cur):
+        self.cur = cur
+
+    def reset(self, config: GpXlsConfig):
+        config.create_checkpoint_table(drop=True)
+
+    def entries(self):
+        self.cur.execute(f"""SELECT * FROM {bkf_checkpoint_table}""")
+        return {row['bkc_path']: {'path': row['bkc_path'], 'branch_id': row['bkc_branch_id'],
+                                  'filename': row['bkc_filename'], 'state': row['bkc_state'],
+                                  'start_id': row['bkc_start_id'], 'batches': row['bkc_batches'],
+                                  'rows': row['bkc_rows']}
+                for row in self.cur.fetchall()}
+
+    def started(self, entry):
+        self.cur.execute(f"""REPLACE INTO {bkf_checkpoint_table}
+                             (bkc_path, bkc_branch_id, bkc_filename, bkc_state, bkc_start_id)
+                             VALUES (%s, %s, %s, 'started', %s)""",
+                         (entry['path'], entry['branch_id'], entry['filename'], entry['start_id']))
+
+    def batch(self, path, rows):
+        self.cur.execute(f"""UPDATE {bkf_checkpoint_table} SET bkc_batches = bkc_batches + 1,
+                             bkc_rows = bkc_rows + %s WHERE bkc_path = %s""", (rows, path))
+
+    def done(self, path):
+        self.cur.execute(f"""UPDATE {bkf_checkpoint_table} SET bkc_state = 'done' WHERE bkc_path = %s""",
+                         (path,))
+
+    # в БД запись уже в транзакции, отдельно сохранять нечего
+    def committed(self):
+        pass
+
+
+class FileJournal:
+    """журнал в локальном файле: по событию на строку, записи дописываются после коммита в БД.
+    Если процесс упал между коммитом батча и записью в журнал, батч просто считается незаписанным -
+    для продолжения это не важно, файл все равно грузится заново"""
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.pending = []
+
+    def reset(self, config: GpXlsConfig):
+        open(self.path, 'w').close()
+
+    def entries(self):
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # недописанная строка при аварийном завершении
+                    logging.warning(f'BROKEN LINE IN {self.path}: {line!r}')
+                    continue
+                if record['event'] == 'started':
+                    entries[record['path']] = dict(record['entry'], state='started', batches=0, rows=0)
+                elif record['event'] == 'batch':
+                    entries[record['path']]['batches'] += 1
+                    entries[record['path']]['rows'] += record['rows']
+                elif record['event'] == 'done':
+                    entries[record['path']]['state'] = 'done'
+        return entries
+
+    def _write(self, record):
+        self.pending.append(record)
+
+    def started(self, entry):
+        self._write({'event': 'started', 'path': entry['path'], 'entry': entry})
+
+    def batch(self, path, rows):
+        self._write({'event': 'batch', 'path': path, 'rows': rows})
+
+    def done(self, path):
+        self._write({'event': 'done', 'path': path})
+
+    def committed(self):
+        """сохраняем записи после коммита их данных"""
+        if not self.pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in self.pending:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+
+def load_file(file, config: GpXlsConfig, journal, cur, conn, batch_size=None):
+    df = GpXlsParser(file, config).parse()
+    entry = {
+        'path': os.path.relpath(file, config.startdir),
+        'branch_id': int(config.get_config(file)['branch_id']),
+        'filename': os.path.basename(file),
+        'start_id': max_bkf_id(cur),
+    }
+    journal.started(entry)
+    conn.commit()
+    journal.committed()
+
+    def commit_batch(rows):
+        # запись о батче коммитится вместе с ним
+        journal.batch(entry['path'], rows)
+        conn.commit()
+        journal.committed()
+    warnings_ = upload_df_to_db(df, cur, conn, commit=False, batch_size=batch_size, on_batch=commit_batch)
+    checksum = FileChecksum()
+    checksum.update(df)
+    store_checksum(cur, (entry['branch_id'], entry['filename']), checksum)
+    journal.done(entry['path'])
+    conn.commit()
+    journal.committed()
+    show_1265_warnings(warnings_)
+    return len(df)
+
+
+def run(resume=False, journal_file=None, startdir=startdir):
+    """journal_file - вести журнал в локальном файле, а не в БД"""
+    filenames = get_filenames(startdir)
+    config = GpXlsConfig(startdir, recreate_tables=not resume)
+    cur, conn = open_db()
+    journal = FileJournal(journal_file) if journal_file else DbJournal(cur)
+    if not resume:
+        journal.reset(config)
+    entries = journal.entries()
+    done = {path for path, entry in entries.items() if entry['state'] == 'done'}
+    for entry in entries.values():
+        if entry['state'] == 'started':
+            deleted = delete_partial_rows(cur, entry)
+            conn.commit()
+            print(f"{entry['path']}: {deleted} rows of unfinished load deleted "
+                  f"({entry['batches']} batches were committed), loading it again")
+    todo = [file for file in filenames if os.path.relpath(file, config.startdir) not in done]
+    if resume:
+        print(f'Resuming: {len(done)} files already loaded, {len(todo)} to go')
+    try:
+        for i, file in enumerate(todo):
+            print()
+            print(f"Loading file {i + 1} of {len(todo)}")
+            load_file(file, config, journal, cur, conn)
+    except MySQLdb.OperationalError:
+        logging.exception('CONNECTION LOST')
+        print('Run with --resume to continue from the unfinished file')
+        raise
+    close_db(cur, conn)
+
+
+if __name__ == "__main__":
+    import sys
+    t1 = time.time()
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    run(resume='--resume' in sys.argv, journal_file=options.get('journal'))
+    t2 = time.time()
+    print('Время выполнения', t2 - t1)
@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import re
 import pandas as pd
 import os
 from db import open_db, close_db
@@ -8,47 +10,134 @@ from secure import gp_branches_table, bkf_table, \
 config_file = 'fields.csv'
 ALTER_CONFIG_SUFFIX = '//add'  # суффикс для колонки с альтернативным набором полей
 NEW_STRING_SEPARATOR =  '$$'# новая строка в csv конфиге отделяется через $$ чтобы удобнее было набирать
+bkf_manifest_table = f'{bkf_table}_manifest'  # какие файлы и в каком виде загружены (инкрементальный режим)
+bkf_checksum_table = f'{bkf_table}_checksum'  # контрольные суммы файлов для сверки с bkf_table
+bkf_checkpoint_table = f'{bkf_table}_checkpoint'  # журнал загрузки для продолжения после сбоя
+bkf_staging_table = f'{bkf_table}_staging'  # сюда идет загрузка в режиме staging, потом она подменяет bkf_table
+bkf_old_table = f'{bkf_table}_old'  # прежняя bkf_table на время подмены
+bkf_checksum_staging_table = f'{bkf_checksum_table}_staging'  # суммы файлов staging, подменяет bkf_checksum_table
+bkf_checksum_old_table = f'{bkf_checksum_table}_old'
+# вторичные индексы bkf_table, в режиме staging создаются после загрузки данных
+bkf_secondary_keys = ['KEY `file` (`bkf_branch_id`, `bkf_filename`)']
+# секционировать bkf_table по филиалам (PARTITION BY LIST по bkf_branch_id, см. partitions.py)
+BKF_PARTITIONED = False
+# движок чтения xls для филиала, если автоматический выбор (reader.pick_engine) не подходит:
+# {'имя филиала': 'xlrd' | 'openpyxl' | 'calamine' | 'pandas'}
+READER_ENGINES = {}
+# что делать со значениями, которые не помещаются в поле bkf_table (см. GpXlsParser._validate_df):
+# truncate - обрезать строку (числа - NULL), null - записать NULL, reject - не загружать строку целиком
+VALIDATION_POLICIES = ('truncate', 'null', 'reject')
+VALIDATION_POLICY = 'null'
+# разрядность целых типов MySQL
+INT_BITS = {'tinyint': 8, 'smallint': 16, 'mediumint': 24, 'int': 32, 'integer': 32, 'bigint': 64}
+
+
+def column_limit(sql_type):
+    """ограничение поля по типу из fields.csv: ('str', длина), ('decimal', предел модуля, знаков после запятой),
+    ('int', минимум, максимум) или None, если не проверяем (text, date и т.п.)"""
+    sql_type = sql_type.lower().strip()
+    match = re.match(r'(var)?char\((\d+)\)', sql_type)
+    if match:
+        return 'str', int(match.group(2))
+    match = re.match(r'decimal\((\d+),\s*(\d+)\)', sql_type)
+    if match:
+        precision, scale = int(match.group(1)), int(match.group(2))
+        return 'decimal', 10.0 ** (precision - scale), scale
+    match = re.match(r'(\w+)(\(\d+\))?\s*(unsigned)?', sql_type)
+    if match and match.group(1) in INT_BITS:
+        bits = INT_BITS[match.group(1)]
+        if match.group(3):
+            return 'int', 0, 2 ** bits - 1
+        return 'int', -2 ** (bits - 1), 2 ** (bits - 1) - 1
+    return None
+
+
+def partition_name(branch_id):
+    return f'p{branch_id}'
+
+
+def partitions_sql(branch_ids):
+    partitions = ',\n'.join(f'    PARTITION {partition_name(i)} VALUES IN ({i})' for i in sorted(branch_ids))
+    return f'\nPARTITION BY LIST (`bkf_branch_id`) (\n{partitions}\n)'
 
 
 class GpXlsConfig:
     """Считывает файл конфигурации с полями, хранит маппер"""
-    def __init__(self, startdir=startdir, csv=config_file, recreate_tables=True):
+    def __init__(self, startdir=startdir, csv=config_file, recreate_tables=True, incremental=False,
+                 branches_indexes=None, validation_policy=None, partitioned=None):
         """recreate tables позволяет парсить xls по одному в отладочных целях, не удаляя при инициализации
            таблицы, уже загруженные в бд.
+           incremental - таблицы не удаляются, а создаются только если их нет, новые филиалы дописываются
+           в gp_branches, создается таблица-манифест загруженных файлов.
+           branches_indexes - словарь филиал: id. Если передан, БД не используется вообще
+           (бенчмарки, отладка парсера без БД).
+           validation_policy - одна из VALIDATION_POLICIES, по умолчанию VALIDATION_POLICY.
+           partitioned - секционировать bkf_table по филиалам, по умолчанию BKF_PARTITIONED.
         """
         logging.info('INITIALIZE CONFIG')
         branch_config = BranchConfig(startdir, gp_branches_table)
-        if recreate_tables:
+        if branches_indexes is not None:
+            recreate_tables = incremental = False
+        if recreate_tables or incremental:
             logging.info('CREATING BRANCH TABLE')
-            branch_config.create_branch_table()
+            branch_config.create_branch_table(drop=not incremental)
             logging.info('UPLOADING GP_BRANCHES')
             branch_config.fill_gp_branches()
         logging.info(f'LOADING FIELDS CONFIG FROM {csv}')
         fields = pd.read_csv(os.path.join(startdir, csv), sep=';', index_col=0, encoding='cp1251')
-        self.fields = fields.applymap(lambda x: x.replace(NEW_STRING_SEPARATOR, '\n') if type(x) == str else x)
-        self.branches_indexes = branch_config.branches_indexes
+        self.fields = fields.replace(re.escape(NEW_STRING_SEPARATOR), '\n', regex=True)
+        # ограничения полей bkf_table по их типам: {поле: column_limit}
+        self.limits = {field: column_limit(sql_type) for field, sql_type in self.fields['TYPE'].items()
+                       if column_limit(sql_type)}
+        self.validation_policy = validation_policy or VALIDATION_POLICY
+        if self.validation_policy not in VALIDATION_POLICIES:
+            raise ValueError(f'Unknown validation policy {self.validation_policy}')
+        if branches_indexes is None:
+            branches_indexes = branch_config.branches_indexes
+        self.branches_indexes = branches_indexes
         self.startdir = startdir
-        if recreate_tables:
+        self.partitioned = BKF_PARTITIONED if partitioned is None else partitioned
+        if recreate_tables or incremental:
             logging.info('CREATING BKF TABLE')
-            self.create_bkf_table()
+            self.create_bkf_table(drop=not incremental)
+            if incremental and self.partitioned:
+                self.add_partitions()
+            logging.info('CREATING CHECKSUM TABLE')
+            self.create_checksum_table(drop=not incremental)
+        if incremental:
+            logging.info('CREATING MANIFEST TABLE')
+            self.create_manifest_table()
 
     def get_config(self, filename):
-        branch_name = filename.split(self.startdir)[1].split('/')[1]  # имя верхней папки
+        branch_name = self.get_branch_name(filename)
         config = self.get_branch_fields(branch_name)
         config['branch_name'] = branch_name
         config['branch_id'] = self.branches_indexes[branch_name]
+        config['reader_engine'] = READER_ENGINES.get(branch_name)
         config['is_alter'] = False
         return config
 
     def get_alter_config(self, filename):
         """У некоторых филиалов поля в файлах отличаются. Поэтому приходится держать альтернативную конфигурацию"""
-        branch_name = filename.split(self.startdir)[1].split('/')[1]  # имя верхней папки
+        branch_name = self.get_branch_name(filename)
         config = self.get_branch_fields(branch_name + ALTER_CONFIG_SUFFIX)
         config['branch_name'] = branch_name
         config['branch_id'] = self.branches_indexes[branch_name]
+        config['reader_engine'] = READER_ENGINES.get(branch_name)
         config['is_alter'] = True
         return config
 
+    def get_branch_name(self, filename):
+        return filename.split(self.startdir)[1].split('/')[1]  # имя верхней папки
+
+    def fingerprint(self, filename):
+        """хэш настроек полей филиала (основной и альтернативной колонки и типов полей) и политики проверки,
+        меняется при любой правке его колонки в fields.csv"""
+        branch_name = self.get_branch_name(filename)
+        columns = ['TYPE'] + [c for c in (branch_name, branch_name + ALTER_CONFIG_SUFFIX) if c in self.fields]
+        data = self.fields[columns].to_csv() + str(self.branches_indexes[branch_name]) + self.validation_policy
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
     def get_branch_fields(self, branch_name):
         branch_fields = self.fields[branch_name].dropna()
         config = {
@@ -58,23 +147,34 @@ class GpXlsConfig:
             'mapper': {v: k for k, v in branch_fields.items()},  # словарь -  русское назв.: англ назв.
             'decimal_fields': [self.fields[branch_name][f] for f in branch_fields.index
                                if 'decimal' in self.fields['TYPE'][f].lower()],
+            'int_fields': [self.fields[branch_name][f] for f in branch_fields.index
+                           if self.fields['TYPE'][f].lower().split('(')[0].endswith('int')],
         }
         return config
 
-    def create_bkf_table(self):
+    def create_bkf_table(self, drop=True, table=bkf_table, secondary_keys=True, partitioned=None, partitions=True):
+        """secondary_keys=False - без вторичных индексов, их добавляют после загрузки (см. staging.py).
+        partitioned - по секции на филиал из branches_indexes. Ключ секционирования должен входить
+        в первичный ключ, поэтому он (bkf_id, bkf_branch_id), а bkf_branch_id - NOT NULL.
+        partitions=False - та же структура без секций: таблица для EXCHANGE PARTITION"""
+        partitioned = self.partitioned if partitioned is None else partitioned
         cur, conn = open_db()
-        cur.execute(f"""DROP TABLE IF EXISTS `{bkf_table}`""")
+        if drop:
+            cur.execute(f"""DROP TABLE IF EXISTS `{table}`""")
+        branch_null = 'NOT NULL' if partitioned else 'DEFAULT NULL'
         HEAD = f"""
-        CREATE TABLE `{bkf_table}` (
+        CREATE TABLE IF NOT EXISTS `{table}` (
             `bkf_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
-            `bkf_branch_id` int(11) DEFAULT NULL COMMENT 'id из gp_branches',  
+            `bkf_branch_id` int(11) {branch_null} COMMENT 'id из gp_branches',
         """
+        keys = ''.join(f',\n             {key}' for key in bkf_secondary_keys) if secondary_keys else ''
         TAIL = """,
             `bkf_row_num` int(11) DEFAULT NULL COMMENT 'Номер строки в файле',
             `bkf_filename` varchar(255) DEFAULT NULL COMMENT 'Имя файла',
-             PRIMARY KEY (`bkf_id`)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci COMMENT='{}';
-        """.format(bkf_table_comment)
+             PRIMARY KEY ({}){}
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci COMMENT='{}'{};
+        """.format('`bkf_id`, `bkf_branch_id`' if partitioned else '`bkf_id`', keys, bkf_table_comment,
+                   partitions_sql(self.branches_indexes.values()) if partitioned and partitions else '')
 
         fields_sql = [f"    `{ix}` {field['TYPE']} DEFAULT NULL COMMENT '{field['DESCRIPTION']}'"
                       for ix, field in self.fields.iterrows()]
@@ -84,17 +184,93 @@ class GpXlsConfig:
         conn.commit()
         close_db(cur, conn)
 
+    def add_partitions(self, table=bkf_table):
+        """секции для филиалов, появившихся после создания таблицы"""
+        cur, conn = open_db()
+        cur.execute("""SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+                       WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table,))
+        existing = {row['PARTITION_NAME'] for row in cur.fetchall()}
+        if None in existing:
+            logging.warning(f'{table} IS NOT PARTITIONED, RECREATE IT TO USE PARTITIONS')
+        else:
+            for branch_name, branch_id in self.branches_indexes.items():
+                if partition_name(branch_id) not in existing:
+                    logging.info(f'ADDING PARTITION {partition_name(branch_id)} FOR {branch_name}')
+                    cur.execute(f"""ALTER TABLE `{table}` ADD PARTITION
+                                    (PARTITION {partition_name(branch_id)} VALUES IN ({branch_id}))""")
+        close_db(cur, conn)
+
+    def create_checksum_table(self, drop=True, table=bkf_checksum_table):
+        cur, conn = open_db()
+        if drop:
+            cur.execute(f"""DROP TABLE IF EXISTS `{table}`""")
+        SQL = f"""
+        CREATE TABLE IF NOT EXISTS `{table}` (
+            `bks_branch_id` int(11) NOT NULL COMMENT 'id из gp_branches',
+            `bks_filename` varchar(255) NOT NULL COMMENT 'Имя файла (bkf_filename)',
+            `bks_rows` int(11) NOT NULL COMMENT 'Число строк',
+            `bks_key_hash` bigint(20) unsigned NOT NULL COMMENT 'Сумма CRC32 ключевых полей строк',
+            `bks_sums` text NOT NULL COMMENT 'Суммы decimal полей, JSON',
+            `bks_updated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+             PRIMARY KEY (`bks_branch_id`, `bks_filename`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci COMMENT='Контрольные суммы файлов {bkf_table}';
+        """
+        cur.execute(SQL)
+        conn.commit()
+        close_db(cur, conn)
+
+    def create_checkpoint_table(self, drop=True):
+        cur, conn = open_db()
+        if drop:
+            cur.execute(f"""DROP TABLE IF EXISTS `{bkf_checkpoint_table}`""")
+        SQL = f"""
+        CREATE TABLE IF NOT EXISTS `{bkf_checkpoint_table}` (
+            `bkc_path` varchar(255) NOT NULL COMMENT 'Путь к файлу относительно startdir',
+            `bkc_branch_id` int(11) NOT NULL COMMENT 'id из gp_branches',
+            `bkc_filename` varchar(255) NOT NULL COMMENT 'Имя файла (bkf_filename)',
+            `bkc_state` enum('started','done') NOT NULL COMMENT 'Файл в работе или загружен',
+            `bkc_start_id` bigint(20) unsigned NOT NULL COMMENT 'Максимальный bkf_id перед загрузкой файла',
+            `bkc_batches` int(11) NOT NULL DEFAULT 0 COMMENT 'Закоммиченных батчей',
+            `bkc_rows` int(11) NOT NULL DEFAULT 0 COMMENT 'Закоммиченных строк',
+            `bkc_updated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+             PRIMARY KEY (`bkc_path`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci COMMENT='Журнал загрузки {bkf_table}';
+        """
+        cur.execute(SQL)
+        conn.commit()
+        close_db(cur, conn)
+
+    def create_manifest_table(self):
+        cur, conn = open_db()
+        SQL = f"""
+        CREATE TABLE IF NOT EXISTS `{bkf_manifest_table}` (
+            `bkm_path` varchar(255) NOT NULL COMMENT 'Путь к файлу относительно startdir',
+            `bkm_branch_id` int(11) NOT NULL COMMENT 'id из gp_branches',
+            `bkm_filename` varchar(255) NOT NULL COMMENT 'Имя файла (bkf_filename)',
+            `bkm_size` bigint(20) NOT NULL COMMENT 'Размер файла',
+            `bkm_mtime` double NOT NULL COMMENT 'Время изменения файла',
+            `bkm_hash` char(40) NOT NULL COMMENT 'sha1 содержимого файла',
+            `bkm_rows` int(11) NOT NULL COMMENT 'Число загруженных строк',
+            `bkm_loaded_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+             PRIMARY KEY (`bkm_path`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci COMMENT='Загруженные в {bkf_table} файлы';
+        """
+        cur.execute(SQL)
+        conn.commit()
+        close_db(cur, conn)
+
 
 class BranchConfig:
     def __init__(self, startdir, gp_branches_table):
         self.startdir = startdir
         self.gp_branches_table = gp_branches_table
 
-    def create_branch_table(self):
+    def create_branch_table(self, drop=True):
         cur, conn = open_db()
-        cur.execute(f"""DROP TABLE IF EXISTS `{self.gp_branches_table}`""")
+        if drop:
+            cur.execute(f"""DROP TABLE IF EXISTS `{self.gp_branches_table}`""")
         SQL = f"""
-        CREATE TABLE `{self.gp_branches_table}` (
+        CREATE TABLE IF NOT EXISTS `{self.gp_branches_table}` (
             `gpb_id` int(11) NOT NULL AUTO_INCREMENT,
             `gpb_name` varchar(255) NOT NULL,
              PRIMARY KEY (`gpb_id`),
@@ -109,7 +285,8 @@ class BranchConfig:
         branches = [e.name for e in os.scandir(startdir) if e.is_dir() and not e.name.startswith('.')]
         cur, conn = open_db()
         for branch in branches:
-            SQL = f"""INSERT INTO {self.gp_branches_table} (gpb_name) VALUES('{branch}');"""
+            # IGNORE - в инкрементальном режиме уже известные филиалы сохраняют свои id
+            SQL = f"""INSERT IGNORE INTO {self.gp_branches_table} (gpb_name) VALUES('{branch}');"""
             cur.execute(SQL)
         conn.commit()
         close_db(cur, conn)
@@ -0,0 +1,115 @@
+"""Индекс инвентарных номеров для поиска дублей прямо во время загрузки.
+Для каждого инвентарного номера хранятся все места, где он встретился: филиал, файл и строка в xls,
+и для каждого файла - его номера, чтобы при перезагрузке или удалении файла убрать только его вхождения.
+Каждый распарсенный датафрейм проверяется по индексу и дописывается в него, дубли печатаются сразу,
+с местом первого вхождения и повтора, без GROUP BY по всей bkf_table после прогона.
+Уникальность - внутри филиала (branch) или по всем филиалам (global).
+Индекс сохраняется в parquet, так что инкрементальная загрузка проверяет новые файлы
+по уже загруженным без запросов к БД.
+"""
+import logging
+import os
+
+import pandas as pd
+
+INDEX_FILE = '.inv_index.parquet'
+SCOPES = ('branch', 'global')
+KEY_FIELD = 'bkf_inv_num'
+
+
+class InventoryIndex:
+    def __init__(self, scope='branch', path=INDEX_FILE, load=True):
+        """load=False - начать с пустого индекса (полная перезаливка)"""
+        if scope not in SCOPES:
+            raise ValueError(f'Unknown scope {scope}')
+        self.scope = scope
+        self.path = path
+        # ключ (id филиала, номер) или номер -> [(id филиала, файл, строка в xls)] в порядке загрузки
+        self.index = {}
+        # (id филиала, файл) -> ключи его номеров
+        self.files = {}
+        self.duplicates = []
+        if load and path and os.path.exists(path):
+            self.load()
+
+    def _key(self, branch_id, inv_num):
+        return (branch_id, inv_num) if self.scope == 'branch' else inv_num
+
+    def _add(self, key, location):
+        self.index.setdefault(key, []).append(location)
+        self.files.setdefault(location[:2], set()).add(key)
+
+    def check(self, df: pd.DataFrame):
+        """проверяет номера датафрейма по индексу и дописывает их вхождения, возвращает найденные дубли"""
+        if not len(df) or KEY_FIELD not in df.columns:
+            return []
+        filled = df[KEY_FIELD].notnull()
+        inv_nums = df[KEY_FIELD][filled].astype(str).tolist()
+        branch_ids = df['bkf_branch_id'][filled].astype(int).tolist()
+        rows = df['bkf_row_num'][filled].astype(int).tolist()
+        filename = str(df['bkf_filename'].iloc[0])
+        found = []
+        index = self.index
+        for branch_id, inv_num, row in zip(branch_ids, inv_nums, rows):
+            key = self._key(branch_id, inv_num)
+            location = (branch_id, filename, row)
+            locations = index.get(key)
+            if locations:
+                found.append({'inv_num': inv_num, 'first': locations[0], 'duplicate': location})
+            self._add(key, location)
+        if found:
+            self.show(found, filename)
+            self.duplicates += found
+        return found
+
+    def show(self, found, filename):
+        logging.warning(f'{len(found)} DUPLICATE INVENTORY NUMBERS IN {filename} ({self.scope} scope)')
+        print()
+        print('*' * 100)
+        print(f'{len(found)} duplicate inventory numbers in {filename} '
+              f'(inv_num, first (branch, file, row), duplicate (branch, file, row)):')
+        for d in found:
+            print(d['inv_num'], d['first'], d['duplicate'])
+        print('*' * 100)
+        print()
+
+    def forget_file(self, branch_id, filename):
+        """убирает вхождения номеров файла перед его перезагрузкой или после удаления,
+        вхождения тех же номеров в других файлах остаются"""
+        keys = self.files.pop((branch_id, filename), set())
+        for key in keys:
+            locations = [loc for loc in self.index[key] if loc[0] != branch_id or loc[1] != filename]
+            if locations:
+                self.index[key] = locations
+            else:
+                del self.index[key]
+        return len(keys)
+
+    def save(self):
+        keys, locations = [], []
+        for key, key_locations in self.index.items():
+            keys += [key] * len(key_locations)
+            locations += key_locations
+        df = pd.DataFrame({
+            'inv_num': [key[1] if self.scope == 'branch' else key for key in keys],
+            'branch_id': [loc[0] for loc in locations],
+            'filename': [loc[1] for loc in locations],
+            'row': [loc[2] for loc in locations],
+        })
+        df.attrs['scope'] = self.scope
+        tmp = self.path + '.tmp'
+        df.to_parquet(tmp)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        df = pd.read_parquet(self.path)
+        if df.attrs.get('scope', self.scope) != self.scope:
+            logging.warning(f'INDEX {self.path} WAS BUILT WITH {df.attrs["scope"]} SCOPE, STARTING WITH AN EMPTY ONE')
+            return
+        for inv_num, branch_id, filename, row in zip(df['inv_num'].tolist(), df['branch_id'].tolist(),
+                                                     df['filename'].tolist(), df['row'].tolist()):
+            self._add(self._key(branch_id, inv_num), (branch_id, filename, row))
+
+    def show_stats(self):
+        logging.info(f'INVENTORY INDEX: {len(self.index)} NUMBERS, {len(self.duplicates)} DUPLICATES')
+        print(f'Inventory index: {len(self.index)} numbers, {len(self.duplicates)} duplicates ({self.scope} scope)')
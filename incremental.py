@@ -0,0 +1,150 @@
+"""Инкрементальная загрузка: вместо пересоздания таблиц грузим только новые и измененные файлы.
+Что и в каком виде уже загружено, хранится в таблице-манифесте (bkf_manifest_table):
+путь, размер, время изменения, sha1 содержимого и число строк.
+Строки измененного файла заменяются в одной транзакции (DELETE по bkf_branch_id + bkf_filename
+и заново INSERT), строки удаленных файлов удаляются.
+Полная перезаливка (recreate_tables) нужна только при изменении структуры таблиц.
+"""
+import logging
+import os
+import time
+from collections import namedtuple
+
+from cache import file_digest
+from config import GpXlsConfig, bkf_manifest_table, startdir, bkf_table, bkf_checksum_table
+from db import open_db, close_db
+from main import get_filenames, upload_df_to_db, show_1265_warnings
+from duplicates import InventoryIndex
+from reconcile import FileChecksum, store_checksum
+from xlsparser import GpXlsParser
+
+# план инкрементальной загрузки: какие файлы грузить, какие удалить, какие не изменились
+DeltaPlan = namedtuple('DeltaPlan', ['load', 'remove', 'unchanged'])
+
+
+def relative_path(file, startdir=startdir):
+    return os.path.relpath(file, startdir)
+
+
+def get_manifest(cur):
+    """словарь путь -> строка манифеста"""
+    cur.execute(f"""SELECT * FROM {bkf_manifest_table}""")
+    return {row['bkm_path']: row for row in cur}
+
+
+def plan_delta(filenames, manifest, startdir=startdir):
+    """сравниваем файлы на диске с манифестом. Если размер и время изменения совпадают - файл
+    не трогаем, если отличаются - считаем хэш, и грузим только если изменилось содержимое"""
+    load, unchanged = [], []
+    on_disk = set()
+    for file in filenames:
+        path = relative_path(file, startdir)
+        on_disk.add(path)
+        stat = os.stat(file)
+        row = manifest.get(path)
+        if row and row['bkm_size'] == stat.st_size and row['bkm_mtime'] == stat.st_mtime:
+            unchanged.append(file)
+        elif row and row['bkm_hash'] == file_digest(file):
+            logging.info(f'{path}: ONLY MTIME CHANGED')
+            unchanged.append(file)
+        else:
+            load.append(file)
+    remove = [row for path, row in manifest.items() if path not in on_disk]
+    return DeltaPlan(load, remove, unchanged)
+
+
+def check_filename_collisions(filenames, config: GpXlsConfig):
+    """строки файла в bkf ищутся по филиалу и имени файла без пути, поэтому два файла
+    с одинаковым именем в разных папках одного филиала заменяли бы строки друг друга"""
+    seen = {}
+    for file in filenames:
+        key = (config.get_branch_name(file), os.path.basename(file))
+        if key in seen:
+            raise ValueError(f'Files {seen[key]} and {file} have the same name in one branch, '
+                             f'incremental load is impossible')
+        seen[key] = file
+
+
+def delete_file_rows(cur, branch_id, filename):
+    cur.execute(f"""DELETE FROM {bkf_table} WHERE bkf_branch_id = %s AND bkf_filename = %s""",
+                (branch_id, filename))
+    return cur.rowcount
+
+
+def load_file(file, config: GpXlsConfig, cur, conn, batch_size=None, index: InventoryIndex = None):
+    """парсит файл и в одной транзакции заменяет его строки в bkf и запись в манифесте.
+    С index старые номера файла убираются из индекса, а новые проверяются на дубли"""
+    stat = os.stat(file)
+    digest = file_digest(file)
+    df = GpXlsParser(file, config).parse()
+    branch_id = config.get_config(file)['branch_id']
+    filename = os.path.basename(file)
+    if index:
+        index.forget_file(branch_id, filename)
+        index.check(df)
+    try:
+        deleted = delete_file_rows(cur, branch_id, filename)
+        logging.info(f'{deleted} OLD ROWS OF {filename} DELETED')
+        warnings_ = upload_df_to_db(df, cur, conn, commit=False, batch_size=batch_size)
+        cur.execute(f"""REPLACE INTO {bkf_manifest_table}
+                        (bkm_path, bkm_branch_id, bkm_filename, bkm_size, bkm_mtime, bkm_hash, bkm_rows)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (relative_path(file, config.startdir), branch_id, filename,
+                     stat.st_size, stat.st_mtime, digest, len(df)))
+        checksum = FileChecksum()
+        checksum.update(df)
+        store_checksum(cur, (int(branch_id), filename), checksum)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    show_1265_warnings(warnings_)
+    return len(df)
+
+
+def remove_file(row, cur, conn, index: InventoryIndex = None):
+    """удаляет строки файла, которого больше нет на диске, и его запись в манифесте"""
+    try:
+        deleted = delete_file_rows(cur, row['bkm_branch_id'], row['bkm_filename'])
+        cur.execute(f"""DELETE FROM {bkf_manifest_table} WHERE bkm_path = %s""", (row['bkm_path'],))
+        cur.execute(f"""DELETE FROM {bkf_checksum_table} WHERE bks_branch_id = %s AND bks_filename = %s""",
+                    (row['bkm_branch_id'], row['bkm_filename']))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    if index:
+        index.forget_file(row['bkm_branch_id'], row['bkm_filename'])
+    logging.info(f"{row['bkm_path']} REMOVED, {deleted} ROWS DELETED")
+    return deleted
+
+
+def run_incremental(startdir=startdir, duplicates=None):
+    """duplicates - branch или global: проверять номера по сохраненному индексу (см. duplicates.py)"""
+    filenames = get_filenames(startdir)
+    index = InventoryIndex(duplicates) if duplicates else None
+    config = GpXlsConfig(startdir, recreate_tables=False, incremental=True)
+    check_filename_collisions(filenames, config)
+    cur, conn = open_db()
+    plan = plan_delta(filenames, get_manifest(cur), config.startdir)
+    print(f'Files to load: {len(plan.load)}, to remove: {len(plan.remove)}, unchanged: {len(plan.unchanged)}')
+    for i, file in enumerate(plan.load):
+        print()
+        print(f"Loading file {i + 1} of {len(plan.load)}")
+        load_file(file, config, cur, conn, index=index)
+    for row in plan.remove:
+        remove_file(row, cur, conn, index)
+    close_db(cur, conn)
+    if index:
+        index.save()
+        index.show_stats()
+    return plan
+
+
+if __name__ == "__main__":
+    import sys
+    t1 = time.time()
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    run_incremental(duplicates=options.get('duplicates'))
+    t2 = time.time()
+    print('Время выполнения', t2 - t1)
@@ -0,0 +1,41 @@
+"""Кэш раскладки шапки для файлов филиалов.
+Файлы одного филиала почти всегда сделаны по одному шаблону: та же строка заголовка,
+то же число строк в шапке и та же (основная или альтернативная //add) конфигурация полей.
+Для каждого филиала храним найденные раскладки вместе с хэшем строк шапки;
+раскладка применяется, только если строки шапки в новом файле дают тот же хэш.
+"""
+import json
+import logging
+import os
+
+LAYOUT_FILE = '.layout_cache.json'
+
+
+class LayoutCache:
+    def __init__(self, path=LAYOUT_FILE):
+        self.path = path
+        self.layouts = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.layouts = json.load(f)
+
+    def get(self, branch_name):
+        """раскладки филиала, последняя найденная - первой"""
+        return self.layouts.get(branch_name, [])
+
+    def add(self, branch_name, layout):
+        layouts = [known for known in self.get(branch_name) if known['digest'] != layout['digest']]
+        self.layouts[branch_name] = [layout] + layouts
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.layouts, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def show_stats(self):
+        logging.info(f'LAYOUT CACHE: {self.hits} HITS, {self.misses} MISSES')
+        print(f'Layout cache: {self.hits} hits, {self.misses} misses')
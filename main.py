@@ -1,9 +1,20 @@
 import logging
 import warnings
 import os
+import time
+from collections import namedtuple
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
-from config import startdir, BLACKLIST, bkf_table
+from config import startdir, bkf_table
 from xlsparser import GpXlsConfig, GpXlsParser
+from cache import ParseCache, parse_cached
+from layout import LayoutCache
+from planner import iter_work, plan_work, PLAN_FILE
+from duplicates import InventoryIndex
+from reconcile import get_checksums
+from batching import get_sizer, estimate_row_bytes
+from metrics import get_metrics, configure as configure_metrics
 from progressbar import printProgressBar
 import MySQLdb
 from db import open_db, close_db
@@ -21,12 +32,17 @@ class XlsIterator:
     Никакой проверки входных данных не делается!
     Класс был сделан для того, чтобы было удобно ходить по списку в юпитер ноутбуке, начиная с разных
     значений и получая по одному датафрейму.
+    Если передан кэш (ParseCache), неизмененные файлы берутся из него без чтения xls.
+    Если передан кэш раскладок шапки (LayoutCache), шапка по возможности берется из него.
     """
-    def __init__(self, filenames, start=0, recreate_tables=True):
+    def __init__(self, filenames, start=0, recreate_tables=True, cache: ParseCache = None,
+                 layouts: LayoutCache = None):
         print('Initializing...')
         self.current = start
         self.filenames = filenames
         self.end = len(filenames)
+        self.cache = cache
+        self.layouts = layouts
         self.config = GpXlsConfig(recreate_tables=recreate_tables)
 
     def __iter__(self):
@@ -38,58 +54,168 @@ class XlsIterator:
 
         print()
         print(f"Reading file {self.current+1} of {self.end}")
-        parser = GpXlsParser(self.filenames[self.current], self.config)
-        df = parser.parse()
+        if self.cache:
+            df = parse_cached(self.filenames[self.current], self.config, self.cache, self.layouts)
+        else:
+            parser = GpXlsParser(self.filenames[self.current], self.config, self.layouts)
+            df = parser.parse()
         self.current += 1
         return df
 
 
-def not_in_blacklist(path):
-    for item in BLACKLIST:
-        if item in path:
-            return False
-    return True
+# служебные поля, одинаковые для всех строк файла (см. GpXlsParser._add_service_fields)
+CONSTANT_FIELDS = ('bkf_branch_id', 'bkf_filename')
 
+# результат парсинга одного файла в пуле процессов: либо df, либо текст ошибки
+ParseResult = namedtuple('ParseResult', ['filename', 'df', 'error'])
 
-def get_filenames(startdir):
-    filenames = []
-    for directory, subdirectories, files in os.walk(startdir):
-        filenames += [os.path.join(directory, file) for file in files if 'xls' in file.lower()]
-    filenames = list(filter(not_in_blacklist, filenames))
-    return filenames
+# конфиг, переданный в процесс-воркер при его старте (чтобы не пиклить его на каждый файл)
+_worker_config = None
 
 
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+def _init_parse_worker(config):
+    global _worker_config
+    _worker_config = config
 
 
-def split_df(df, batch_size):
-    """Разделяет датафрейм на списки словарей заданного размера"""
-    full_batch = [row.to_dict() for index, row in df.iterrows()]
-    return chunks(full_batch, batch_size)
+def parse_file(filename):
+    """Парсит один файл в процессе-воркере. Исключение не бросаем, а возвращаем как результат,
+    чтобы ошибка в одном файле не останавливала весь прогон"""
+    try:
+        df = GpXlsParser(filename, _worker_config).parse()
+    except Exception as e:
+        logging.exception(f'ERROR WHILE PARSING {filename}')
+        return ParseResult(filename, None, f'{type(e).__name__}: {e}')
+    return ParseResult(filename, df, None)
 
 
-def get_address_from_mysql_warning(warning: Warning):
-    text = warning.args[1].split("'")
+class ProcessXlsIterator:
+    """То же, что XlsIterator, но файлы парсятся параллельно в пуле процессов.
+    read_excel и обработка в pandas держат GIL, поэтому треды не дают выигрыша, а процессы - дают.
+    Результаты (ParseResult) отдаются в порядке готовности, а не в порядке списка файлов.
+    Одновременно в работе не больше 2 * processes файлов, чтобы готовые датафреймы
+    не копились в памяти, если загрузка в БД не успевает.
+    С кэшем (ParseCache) найденные в нем файлы отдаются сразу из основного процесса,
+    а в пул уходят только измененные, их результат кладется в кэш.
+    """
+    def __init__(self, filenames, start=0, recreate_tables=True, processes=None, cache: ParseCache = None):
+        print('Initializing...')
+        self.filenames = filenames[start:]
+        self.end = len(filenames)
+        self.start = start
+        self.processes = processes or os.cpu_count()
+        self.cache = cache
+        self.config = GpXlsConfig(recreate_tables=recreate_tables)
+
+    def _cached_files(self, keys):
+        """отдает файлы из кэша, остальные складывает в keys для отправки в пул"""
+        for filename in self.filenames:
+            if not self.cache:
+                yield filename, None
+                continue
+            key = self.cache.key(filename, self.config)
+            df = self.cache.get(key)
+            if df is None:
+                keys[filename] = key
+                yield filename, None
+            else:
+                yield filename, df
+
+    def __iter__(self):
+        pending = set()
+        keys = {}
+        work = self._cached_files(keys)
+        done_count = self.start
+        with ProcessPoolExecutor(self.processes, initializer=_init_parse_worker,
+                                 initargs=(self.config,)) as executor:
+            while True:
+                # дозаполняем пул, файлы из кэша отдаем сразу
+                for filename, df in work:
+                    if df is not None:
+                        done_count += 1
+                        print(f"File {done_count} of {self.end} from cache: {filename}")
+                        yield ParseResult(filename, df, None)
+                        continue
+                    pending.add(executor.submit(parse_file, filename))
+                    if len(pending) >= 2 * self.processes:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_count += 1
+                    result = future.result()
+                    print()
+                    print(f"Parsed file {done_count} of {self.end}: {result.filename}")
+                    if self.cache and result.df is not None:
+                        self.cache.put(keys.pop(result.filename), result.df)
+                    yield result
+
+
+def iter_filenames(startdir):
+    """отдает файлы по мере обхода дерева, чтобы их можно было обрабатывать, не дожидаясь конца обхода"""
+    for item in iter_work(startdir):
+        yield item.path
+
+
+def get_filenames(startdir, plan_file=None, reuse_plan=False):
+    """файлы от больших к меньшим (см. planner.plan_work)"""
+    return [item.path for item in plan_work(startdir, plan_file, reuse_plan)]
+
+
+def column_values(series: pd.Series):
+    """значения столбца списком python-объектов, NaN заменяется на None.
+    служебные поля с одним значением на весь файл не копируем, а повторяем"""
+    if series.name in CONSTANT_FIELDS and len(series):
+        value = series.iloc[0]
+        return repeat(None if pd.isnull(value) else value.item() if hasattr(value, 'item') else value)
+    values = series.to_numpy(dtype=object, copy=True)
+    values[series.isnull().to_numpy()] = None
+    return values.tolist()
+
+
+def encode_batches(df: pd.DataFrame, batch_size):
+    """Разделяет датафрейм на списки кортежей (в порядке столбцов df) заданного размера.
+    Строки собираются из столбцов, без промежуточных словарей и копии датафрейма,
+    батчи отдаются по мере надобности. batch_size - число или AdaptiveBatchSize,
+    тогда размер каждого батча спрашивается у него перед сборкой"""
+    rows = zip(*[column_values(df[col]) for col in df.columns])
+    while True:
+        size = batch_size if isinstance(batch_size, int) else batch_size.next_size()
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_address_from_message(message: str):
+    """из текста 'Data truncated for column 'field' at row N' достаем номер строки и поле"""
+    text = message.split("'")
     field = text[1]
     row_num = text[2].split()[-1]
     return int(row_num), field
 
 
-def upload_batch(SQL, batch, cur, conn):
+def get_address_from_mysql_warning(warning: Warning):
+    return get_address_from_message(warning.args[1])
+
+
+def upload_batch(SQL, columns, batch, cur, conn, commit=True):
+    """columns - имена полей в том порядке, в котором они лежат в кортежах батча"""
     warnings_ = []
+    metrics = get_metrics()
+    if metrics.enabled:
+        t1 = time.perf_counter()
     try:
         cur.executemany(SQL, batch)
     except MySQLdb.Warning as e:
         if 'Data truncated for column' in e.args[1]:
             row_num, field = get_address_from_mysql_warning(e)
-            value = batch[row_num][field]
+            value = batch[row_num][columns.index(field)]
             warnings_.append(
                 {
                     'row_num': row_num,
-                    'file_row_num': batch[row_num]['bkf_row_num'],
+                    'file_row_num': batch[row_num][columns.index('bkf_row_num')],
                     'field': field,
                     'value': value,
                     'type': type(value),
@@ -102,7 +228,12 @@ def upload_batch(SQL, batch, cur, conn):
             print('Unexpected MySQL Warning:', e)
             print('*' * 100)
             print()
-    conn.commit()
+    if commit:
+        conn.commit()
+    if metrics.enabled and batch:
+        row = batch[0]
+        metrics.upload(f"{row[columns.index('bkf_branch_id')]}/{row[columns.index('bkf_filename')]}",
+                       len(batch), time.perf_counter() - t1)
     return warnings_
 
 
@@ -117,54 +248,174 @@ def show_1265_warnings(warnings_):
         print()
 
 
-def upload_df_with_batches(SQL, df, queue=None, batch_size=500):
-    # чтобы cursor.execute() это ел, нужно NaN заменить на None
-    # поскольку согласно stackoverflow, такая замена может вызвать некорректную работу датафрейма,
-    # мы это делаем непосредственно перед загрузкой
-    df = df.where(df.notnull(), None)
-    batches = list(split_df(df, batch_size))
-    length = len(batches)
-    logging.info(f'ALL ITEMS: {sum([len(batch) for batch in batches])} IN {length} BATCHES')
+def upload_df_to_db(df: pd.DataFrame, cur, conn, table=bkf_table, commit=True, batch_size=None, on_batch=None):
+    """грузит датафрейм в table через открытое соединение, возвращает 1265 варнинги.
+    batch_size=None - размер батча подбирается по времени загрузки (см. batching.py) и переходит
+    к следующему файлу этого треда, можно передать число или свой AdaptiveBatchSize.
+    commit=False - батчи не коммитятся, коммитит вызывающий (например, вместе с манифестом).
+    on_batch(rows) вызывается после каждого батча, до замера его времени"""
+    SQL = insert_sql(df, table)
+    columns = list(df.columns)
+    sizer = batch_size or get_sizer(cur)
+    if not isinstance(sizer, int):
+        sizer.fit(estimate_row_bytes(df))
+    warnings_ = []
+    for batch in encode_batches(df, sizer):
+        t1 = time.perf_counter()
+        warnings_ += upload_batch(SQL, columns, batch, cur, conn, commit=commit)
+        if on_batch:
+            on_batch(len(batch))
+        if not isinstance(sizer, int):
+            sizer.record(len(batch), time.perf_counter() - t1)
+    if not isinstance(sizer, int) and len(df):
+        sizer.report(df['bkf_filename'].iloc[0])
+    return warnings_
+
+
+def upload_df_with_batches(SQL, df, queue=None, batch_size=None):
+    """batch_size=None - размер батча подбирается по времени загрузки (см. batching.py),
+    в очередь (UploadPool) батчи режутся по размеру пула, время их загрузки сообщают треды пула"""
+    # чтобы cursor.execute() это ел, NaN заменяется на None прямо при сборке батчей (encode_batches)
+    columns = list(df.columns)
+    # контрольные суммы файла для сверки после загрузки (см. reconcile.py)
+    get_checksums().add(df)
+    logging.info(f'ALL ITEMS: {len(df)}')
     logging.info(f'DF SHAPE: {df.shape}')
     warnings_ = []
     if not queue:
         cur, conn = open_db()
         logging.info(f"Uploading items")
         progress_string = 'Uploading dataframe to DB: '
-        printProgressBar(0, length, prefix=progress_string, suffix='Complete', length=100)
-        for i, batch in enumerate(batches):
-            warnings_ = upload_batch(SQL, batch, cur, conn)
-            printProgressBar(i+1, length, prefix=progress_string, suffix='Complete', length=100)
+        printProgressBar(0, len(df), prefix=progress_string, suffix='Complete', length=100)
+        done = 0
+
+        def progress(rows):
+            nonlocal done
+            done += rows
+            printProgressBar(done, len(df), prefix=progress_string, suffix='Complete', length=100)
+        warnings_ = upload_df_to_db(df, cur, conn, batch_size=batch_size, on_batch=progress)
         conn.commit()
         close_db(cur, conn)
     else:
-        print('Putting {} to Queue...'.format(batches[0][0]['bkf_filename']))
-        for batch in batches:
-            queue.put((SQL, batch))
+        print('Putting {} to Queue...'.format(df['bkf_filename'].iloc[0]))
+        for batch in encode_batches(df, batch_size or queue.fit(df)):
+            queue.put((SQL, columns, batch))
     show_1265_warnings(warnings_)
 
 
-def upload_df(df: pd.DataFrame, queue=None):
+def insert_sql(df: pd.DataFrame, table=bkf_table):
     fields = ', '.join(df.columns)
-    values_fields = [f'%({field})s' for field in df.columns]
-    values_fields = ', '.join(values_fields)
-    SQL = f"""INSERT INTO {bkf_table} ({fields}) \n
+    values_fields = ', '.join(['%s'] * len(df.columns))
+    SQL = f"""INSERT INTO {table} ({fields}) \n
                 VALUES ({values_fields})"""
-    upload_df_with_batches(SQL, df, queue)
+    return SQL
+
+
+def upload_df(df: pd.DataFrame, queue=None):
+    upload_df_with_batches(insert_sql(df), df, queue)
+
+
+def upload_file_by_chunks(parser: GpXlsParser, queue=None, chunk_size=10000):
+    """Потоковая загрузка: файл парсится кусками, каждый кусок сразу уходит в БД.
+    С ограниченной по размеру очередью (см. th_main) кусок грузится, пока читается следующий,
+    а память не растет с размером файла."""
+    for df in parser.parse_chunks(chunk_size):
+        if len(df):
+            upload_df(df, queue)
+
+
+def check_duplicates(index: InventoryIndex, df: pd.DataFrame):
+    """номера файла, сохраненные прошлым прогоном (с --parquet индекс не пересоздается),
+    заменяются новыми, иначе файл оказывается дублем самого себя"""
+    if len(df):
+        index.forget_file(int(df['bkf_branch_id'].iloc[0]), str(df['bkf_filename'].iloc[0]))
+    index.check(df)
 
 
-def main():
-    filenames = get_filenames(startdir)
+def main(processes=None, use_cache=False, upload=upload_df, use_layouts=False, plan_file=None, reuse_plan=False,
+         recreate_tables=True, duplicates=None, save_checksums=True):
+    """upload - функция или синк (см. sinks.py), в который уходит каждый распарсенный датафрейм.
+    duplicates - branch или global: проверять инвентарные номера на дубли (см. duplicates.py).
+    save_checksums=False - контрольные суммы сохраняет вызывающий (staging.py - вместе с подменой таблицы)"""
+    filenames = get_filenames(startdir, plan_file, reuse_plan)
+    index = InventoryIndex(duplicates, load=not recreate_tables) if duplicates else None
     # file = [i for i in filenames if 'Казань' in i][0]
     # index = filenames.index(file)
-    walkall = XlsIterator(filenames, 0)
-    for df in walkall:
-        upload_df(df)
+    cache = ParseCache() if use_cache else None
+    if not processes:
+        layouts = LayoutCache() if use_layouts else None
+        walkall = XlsIterator(filenames, 0, recreate_tables, cache=cache, layouts=layouts)
+        for df in walkall:
+            if index:
+                check_duplicates(index, df)
+            upload(df)
+        if cache:
+            cache.show_stats()
+        if layouts:
+            layouts.show_stats()
+        if index:
+            index.save()
+            index.show_stats()
+        if save_checksums:
+            get_checksums().save()
+        return
+    errors = []
+    for result in ProcessXlsIterator(filenames, 0, recreate_tables, processes=processes, cache=cache):
+        if result.error:
+            errors.append(result)
+            continue
+        if index:
+            check_duplicates(index, result.df)
+        upload(result.df)
+    if errors:
+        logging.warning(f'{len(errors)} FILES WAS NOT PARSED:')
+        for result in errors:
+            print(result.filename, result.error)
+    if cache:
+        cache.show_stats()
+    if index:
+        index.save()
+        index.show_stats()
+    if save_checksums:
+        get_checksums().save()
 
 
 if __name__ == "__main__":
-    import time
+    import sys
     t1 = time.time()
-    main()
+    # число процессов для парсинга можно передать первым аргументом, --cache включает кэш парсинга,
+    # --bulk - загрузку через LOAD DATA LOCAL INFILE, --layouts - кэш раскладок шапки (без пула процессов),
+    # --metrics=file.jsonl - запись метрик по этапам, --profile=dir - профили самых медленных файлов,
+    # --plan - сохранить план файлов в PLAN_FILE, --reuse-plan - взять файлы из него без обхода дерева,
+    # --parquet=dir - писать в parquet вместо БД (таблицы не пересоздаются), --replace - перезаписывать филиалы,
+    # --policy=truncate|null|reject - что делать со значениями, не помещающимися в поля (config.VALIDATION_POLICY),
+    # --duplicates=branch|global - искать дубли инвентарных номеров внутри филиала или по всем филиалам
+    # --partitioned - создать bkf_table с секциями по филиалам (config.BKF_PARTITIONED, см. partitions.py)
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    if 'policy' in options:
+        import config
+        config.VALIDATION_POLICY = options['policy']
+    if '--partitioned' in sys.argv:
+        import config
+        config.BKF_PARTITIONED = True
+    if 'metrics' in options:
+        configure_metrics(path=options['metrics'], profile_dir=options.get('profile'))
+    upload = upload_df
+    if '--bulk' in sys.argv:
+        from bulk import upload_df_infile as upload
+    if 'parquet' in options:
+        from sinks import ParquetSink
+        # из БД читаются только id филиалов
+        upload = ParquetSink(GpXlsConfig(startdir, recreate_tables=False), options['parquet'],
+                             'replace' if '--replace' in sys.argv else 'append')
+    main(int(args[0]) if args else None, use_cache='--cache' in sys.argv, upload=upload,
+         use_layouts='--layouts' in sys.argv,
+         plan_file=PLAN_FILE if '--plan' in sys.argv or '--reuse-plan' in sys.argv else None,
+         reuse_plan='--reuse-plan' in sys.argv, recreate_tables='parquet' not in options,
+         duplicates=options.get('duplicates'))
+    if 'parquet' in options:
+        upload.close()
+    get_metrics().close()
     t2 = time.time()
     print('Время выполнения', t2 - t1)
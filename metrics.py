@@ -0,0 +1,183 @@
+"""Метрики парсинга и загрузки: время, строки на входе и выходе, выкинутый мусор,
+пиковая память процесса и объем прочитанных файлов по каждому этапу и файлу.
+По умолчанию сбор выключен (NullMetrics) и стоит одну проверку флага на этап.
+Включается через configure(): записи уходят в sink - любую функцию, принимающую словарь,
+например JsonLinesSink, который пишет по одному JSON на строку.
+С profile_dir самые медленные файлы дополнительно профилируются cProfile.
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# этап парсера, после которого строки готовы к загрузке, и этап удаления мусорных строк
+FINAL_STAGE = 'service_fields'
+TRASH_STAGE = 'clear'
+
+
+def peak_rss():
+    """пиковая память процесса в байтах (ru_maxrss в линуксе - в килобайтах)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NullMetrics:
+    enabled = False
+
+    @contextmanager
+    def file(self, path):
+        yield
+
+    def stage(self, name, seconds, rows_in, rows_out):
+        pass
+
+    def upload(self, filename, rows, seconds):
+        pass
+
+    def close(self):
+        pass
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, sink, profile_dir=None, profile_top=5):
+        self.sink = sink
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.started = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.stage_totals = defaultdict(float)
+        self.uploads = defaultdict(lambda: {'batches': 0, 'rows': 0, 'seconds': 0.0})
+        # самые медленные файлы с дампом профиля: [(время, путь к дампу)]
+        self.profiled = []
+        self.profile_count = 0
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def file(self, path):
+        """метрики одного файла: этапы, записанные внутри, попадают в его запись"""
+        record = {
+            'type': 'file',
+            'file': path,
+            'bytes_read': os.path.getsize(path),
+            'stages': [],
+        }
+        self.local.record = record
+        profiler = cProfile.Profile() if self.profile_dir else None
+        t1 = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+            record['seconds'] = time.perf_counter() - t1
+            record['peak_rss'] = peak_rss()
+            stages = record['stages']
+            record['rows_out'] = sum(st['rows_out'] or 0 for st in stages if st['stage'] == FINAL_STAGE)
+            record['trash_rows'] = sum(st['dropped'] or 0 for st in stages if st['stage'] == TRASH_STAGE)
+            self.local.record = None
+            with self.lock:
+                self.files += 1
+            if profiler:
+                self._keep_profile(path, record, profiler)
+            self.sink(record)
+
+    def _keep_profile(self, path, record, profiler):
+        """сохраняем профиль, только если файл входит в profile_top самых медленных"""
+        with self.lock:
+            if len(self.profiled) >= self.profile_top and record['seconds'] <= self.profiled[0][0]:
+                return
+            self.profile_count += 1
+            dump = os.path.join(self.profile_dir, f'{self.profile_count}_{os.path.basename(path)}.prof')
+            profiler.dump_stats(dump)
+            record['profile'] = dump
+            self.profiled.append((record['seconds'], dump))
+            self.profiled.sort()
+            while len(self.profiled) > self.profile_top:
+                _, old = self.profiled.pop(0)
+                os.remove(old)
+
+    def stage(self, name, seconds, rows_in, rows_out):
+        with self.lock:
+            self.stage_totals[name] += seconds
+        record = getattr(self.local, 'record', None)
+        if record is not None:
+            record['stages'].append({
+                'stage': name,
+                'seconds': seconds,
+                'rows_in': rows_in,
+                'rows_out': rows_out,
+                'dropped': rows_in - rows_out if rows_in is not None and rows_out is not None else None,
+                'peak_rss': peak_rss(),
+            })
+
+    def upload(self, filename, rows, seconds):
+        """filename - 'id филиала/имя файла', имена файлов в разных филиалах совпадают"""
+        with self.lock:
+            stats = self.uploads[filename]
+            stats['batches'] += 1
+            stats['rows'] += rows
+            stats['seconds'] += seconds
+
+    def close(self):
+        """итоговая запись по прогону"""
+        self.sink({
+            'type': 'run',
+            'seconds': time.time() - self.started,
+            'files': self.files,
+            'stages': dict(self.stage_totals),
+            'uploads': dict(self.uploads),
+            'upload_rows': sum(u['rows'] for u in self.uploads.values()),
+            'upload_seconds': sum(u['seconds'] for u in self.uploads.values()),
+            'peak_rss': peak_rss(),
+            'profiles': [dump for _, dump in self.profiled],
+        })
+        close = getattr(self.sink, 'close', None)
+        if close:
+            close()
+
+
+_metrics = NullMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def configure(sink=None, path=None, profile_dir=None, profile_top=5):
+    """включает сбор метрик: в sink (функция от словаря) или в JSON lines файл path"""
+    global _metrics
+    if sink is None:
+        sink = JsonLinesSink(path)
+    _metrics = Metrics(sink, profile_dir, profile_top)
+    return _metrics
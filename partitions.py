@@ -0,0 +1,159 @@
+"""Загрузка в bkf_table, секционированную по филиалам (PARTITION BY LIST по bkf_branch_id,
+секция на каждый id из gp_branches, см. GpXlsConfig.create_bkf_table).
+Каждый филиал грузит свой процесс со своим соединением: процессы пишут в разные секции
+и не толкаются на одних страницах индексов. Филиалы раздаются от самого большого к меньшим.
+Перезаливка одного филиала не удаляет строки по одной:
+    по умолчанию файлы грузятся в отдельную таблицу той же структуры, и она одним
+    ALTER TABLE ... EXCHANGE PARTITION подменяет секцию филиала - читатели до последнего момента видят
+    прежние строки;
+    с --truncate секция очищается TRUNCATE PARTITION и заполняется заново.
+Если какой-то файл филиала не распарсился, подмена секции отменяется и филиал остается прежним
+(как в инкрементальной загрузке, где строки такого файла не трогаются). С --partial филиал все равно
+заменяется, и строки нераспарсенных файлов пропадают; --truncate без --partial не работает - очищенную
+секцию вернуть нельзя. При полной загрузке в новую таблицу терять нечего, там ошибки только печатаются,
+а строки пишутся прямо в пустые секции: TRUNCATE и EXCHANGE PARTITION нужны только при перезаливке филиала.
+
+    python partitions.py [число процессов]                    - пересоздать таблицы и загрузить все филиалы
+    python partitions.py --branch=имя [--truncate] [--partial] - перезалить один филиал
+"""
+import logging
+import time
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import GpXlsConfig, BranchConfig, startdir, gp_branches_table, bkf_table, bkf_checksum_table, \
+    partition_name
+from db import open_db, close_db
+from main import upload_df_to_db, show_1265_warnings
+from planner import plan_work
+from reconcile import get_checksums
+from xlsparser import GpXlsParser
+
+# applied - данные филиала заменены (False - подмена отменена из-за ошибок)
+BranchResult = namedtuple('BranchResult', ['branch', 'files', 'rows', 'seconds', 'errors', 'applied'])
+
+
+def exchange_table(branch_id):
+    return f'{bkf_table}_x{branch_id}'
+
+
+def branch_files(startdir=startdir):
+    """[(филиал, [файлы])] от филиала с самым большим объемом файлов к меньшим"""
+    files, sizes = defaultdict(list), defaultdict(int)
+    for item in plan_work(startdir):
+        if item.branch is None:
+            continue
+        files[item.branch].append(item.path)
+        sizes[item.branch] += item.size
+    return [(branch, files[branch]) for branch in sorted(files, key=lambda b: -sizes[b])]
+
+
+def truncate_partition(cur, branch_id, table=bkf_table):
+    cur.execute(f'ALTER TABLE `{table}` TRUNCATE PARTITION {partition_name(branch_id)}')
+
+
+def exchange_partition(cur, branch_id, source, table=bkf_table):
+    """source становится секцией филиала, прежние строки секции оказываются в source"""
+    cur.execute(f'ALTER TABLE `{table}` EXCHANGE PARTITION {partition_name(branch_id)} WITH TABLE `{source}`')
+
+
+def next_bkf_id(cur, table=bkf_table):
+    cur.execute(f"""SELECT MAX(bkf_id) AS max_id FROM `{table}`""")
+    return (cur.fetchone()['max_id'] or 0) + 1
+
+
+def load_branch(branch_name, files, config: GpXlsConfig, exchange=False, batch_size=None, partial=False,
+                fresh=False):
+    """парсит файлы филиала и грузит их в его секцию: через EXCHANGE PARTITION или после TRUNCATE PARTITION.
+    partial - заменить секцию, даже если часть файлов не распарсилась (их прежние строки пропадут).
+    fresh - таблица только что создана и секция пуста: строки пишутся прямо в нее без TRUNCATE PARTITION,
+    который берет блокировку метаданных всей таблицы и выстроил бы параллельные загрузки в очередь"""
+    if not exchange and not partial:
+        raise ValueError('TRUNCATE PARTITION drops rows of files that fail to parse, it needs partial=True')
+    t1 = time.time()
+    branch_id = config.branches_indexes[branch_name]
+    cur, conn = open_db()
+    target = bkf_table
+    if exchange:
+        target = exchange_table(branch_id)
+        config.create_bkf_table(drop=True, table=target, partitioned=True, partitions=False)
+        # bkf_id остаются уникальными по всей таблице, как при обычной загрузке
+        cur.execute(f'ALTER TABLE `{target}` AUTO_INCREMENT = {next_bkf_id(cur)}')
+    elif not fresh:
+        truncate_partition(cur, branch_id)
+    rows, errors = 0, []
+    for file in files:
+        try:
+            df = GpXlsParser(file, config).parse()
+        except Exception as e:
+            logging.exception(f'FAILED TO PARSE {file}')
+            errors.append((file, repr(e)))
+            continue
+        if not len(df):
+            continue
+        get_checksums().add(df)
+        warnings_ = upload_df_to_db(df, cur, conn, target, commit=False, batch_size=batch_size)
+        conn.commit()
+        show_1265_warnings(warnings_)
+        rows += len(df)
+    if errors and not partial:
+        logging.error(f'{len(errors)} FILES OF {branch_name} FAILED, PARTITION {partition_name(branch_id)} IS KEPT')
+        cur.execute(f'DROP TABLE `{target}`')
+        get_checksums().discard()
+        close_db(cur, conn)
+        return BranchResult(branch_name, len(files), rows, time.time() - t1, errors, False)
+    if exchange:
+        exchange_partition(cur, branch_id, target)
+        cur.execute(f'DROP TABLE `{target}`')
+    # суммы прежних файлов филиала заменяются новыми одним коммитом
+    cur.execute(f"""DELETE FROM {bkf_checksum_table} WHERE bks_branch_id = %s""", (branch_id,))
+    get_checksums().save(cur, conn)
+    conn.commit()
+    close_db(cur, conn)
+    return BranchResult(branch_name, len(files), rows, time.time() - t1, errors, True)
+
+
+def show_result(result: BranchResult):
+    print(f'{result.branch}: {result.files} files, {result.rows} rows in {result.seconds:.1f} s'
+          + ('' if result.applied else ', NOT APPLIED: some files failed to parse'))
+    for file, error in result.errors:
+        print('   ', file, error)
+
+
+def load_partitioned(startdir=startdir, processes=None):
+    """пересоздает таблицы с секциями и грузит филиалы параллельно, по процессу на филиал"""
+    config = GpXlsConfig(startdir, recreate_tables=True, partitioned=True)
+    branches = branch_files(startdir)
+    print(f'{len(branches)} branches to load')
+    with ProcessPoolExecutor(processes) as pool:
+        # таблица новая, прежних строк нет: нераспарсенные файлы только печатаются
+        futures = [pool.submit(load_branch, branch, files, config, partial=True, fresh=True)
+                   for branch, files in branches]
+        for future in as_completed(futures):
+            show_result(future.result())
+
+
+def reload_branch(branch_name, startdir=startdir, exchange=True, partial=False):
+    branch_config = BranchConfig(startdir, gp_branches_table)
+    branch_config.fill_gp_branches()
+    config = GpXlsConfig(startdir, recreate_tables=False, partitioned=True)
+    if branch_name not in config.branches_indexes:
+        raise ValueError(f'Unknown branch {branch_name}')
+    # секция для филиала, появившегося после создания таблицы
+    config.add_partitions()
+    files = dict(branch_files(startdir)).get(branch_name, [])
+    result = load_branch(branch_name, files, config, exchange, partial=partial)
+    show_result(result)
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    t1 = time.time()
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    if 'branch' in options:
+        reload_branch(options['branch'], exchange='--truncate' not in sys.argv, partial='--partial' in sys.argv)
+    else:
+        load_partitioned(processes=int(args[0]) if args else None)
+    print('Время выполнения', time.time() - t1)
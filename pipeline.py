@@ -0,0 +1,273 @@
+"""Конвейер загрузки: поиск файлов -> парсинг -> загрузка в БД.
+Этапы работают одновременно и связаны ограниченными очередями: загрузка первого файла
+начинается, пока обход дерева еще идет, а конфиг и таблицы создаются параллельно с обходом.
+У каждого этапа свое число воркеров. Ошибка в любом этапе отменяет весь конвейер
+и пробрасывается из run() как PipelineError; этапы с skip_errors только записывают ошибку
+по элементу и продолжают (кроме PipelineError, брошенной самой функцией этапа).
+В конце печатается сводка по этапам.
+
+    python pipeline.py --parse-workers=4 --upload-workers=2 [--processes]
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Empty, Full
+
+from config import GpXlsConfig, startdir
+from db import open_db, close_db
+from main import iter_filenames, upload_df_to_db, show_1265_warnings, \
+    parse_file, _init_parse_worker
+from reconcile import get_checksums
+from xlsparser import GpXlsParser
+
+# признак конца потока элементов в очереди
+_DONE = object()
+# как часто воркеры, ждущие очередь, проверяют отмену
+POLL_INTERVAL = 0.1
+# пул процессов создается, когда треды конвейера уже работают: fork из многопоточного процесса
+# копирует чужие захваченные блокировки (например, logging), и процесс-потомок может повиснуть
+PROCESS_START_METHOD = 'forkserver'
+
+
+class PipelineError(Exception):
+    def __init__(self, stage, item, error):
+        super().__init__(f'Stage {stage} failed on {item!r}: {type(error).__name__}: {error}')
+        self.stage = stage
+        self.item = item
+        self.error = error
+
+
+class Stage:
+    """этап конвейера. func(item) или func(item, state), если задан setup:
+    state создается setup() в каждом воркере (например, соединение с БД) и закрывается teardown(state).
+    Результат, отличный от None, уходит в следующий этап."""
+    def __init__(self, name, func, workers=1, queue_size=10, setup=None, teardown=None, skip_errors=False):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.setup = setup
+        self.teardown = teardown
+        self.skip_errors = skip_errors
+        self.items = 0
+        self.busy = 0.0
+        self.failures = []
+        self.running = workers
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    def __init__(self, source, stages):
+        """source - итерируемый источник элементов (обходится в отдельном треде)"""
+        self.source = source
+        self.stages = stages
+        self.queues = [Queue(stage.queue_size) for stage in stages]
+        self.cancelled = threading.Event()
+        self.error = None
+        self.results = []
+        self.source_items = 0
+
+    def cancel(self, error=None):
+        if error is not None and self.error is None:
+            self.error = error
+        self.cancelled.set()
+
+    def _put(self, queue, item):
+        while not self.cancelled.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue):
+        while not self.cancelled.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+        return _DONE
+
+    def _finish(self, index):
+        """последний завершившийся воркер этапа отправляет конец потока всем воркерам следующего"""
+        if index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self._put(self.queues[index + 1], _DONE)
+
+    def _run_source(self):
+        try:
+            for item in self.source:
+                if not self._put(self.queues[0], item):
+                    return
+                self.source_items += 1
+        except Exception as e:
+            logging.exception('PIPELINE SOURCE FAILED')
+            self.cancel(PipelineError('source', None, e))
+        finally:
+            self._finish(-1)
+
+    def _run_worker(self, index):
+        stage = self.stages[index]
+        state = None
+        try:
+            if stage.setup:
+                state = stage.setup()
+            while True:
+                item = self._get(self.queues[index])
+                if item is _DONE:
+                    break
+                t1 = time.perf_counter()
+                try:
+                    result = stage.func(item, state) if stage.setup else stage.func(item)
+                except PipelineError:
+                    # фатальная ошибка, которую функция этапа бросила сама, skip_errors ее не глотает
+                    raise
+                except Exception as e:
+                    if not stage.skip_errors:
+                        raise PipelineError(stage.name, item, e)
+                    logging.exception(f'{stage.name.upper()}: ERROR ON {item!r}')
+                    with stage.lock:
+                        stage.failures.append((item, f'{type(e).__name__}: {e}'))
+                    continue
+                finally:
+                    with stage.lock:
+                        stage.busy += time.perf_counter() - t1
+                with stage.lock:
+                    stage.items += 1
+                if result is None:
+                    continue
+                if index + 1 < len(self.stages):
+                    if not self._put(self.queues[index + 1], result):
+                        break
+                else:
+                    with stage.lock:
+                        self.results.append(result)
+        except PipelineError as e:
+            logging.error(str(e))
+            self.cancel(e)
+        except Exception as e:
+            logging.exception(f'{stage.name.upper()}: WORKER FAILED')
+            self.cancel(PipelineError(stage.name, None, e))
+        finally:
+            if stage.teardown and state is not None:
+                stage.teardown(state)
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last:
+                self._finish(index)
+
+    def run(self):
+        t1 = time.time()
+        threads = [threading.Thread(target=self._run_source, name='source')]
+        for index, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self._run_worker, args=(index,), name=f'{stage.name}-{i}')
+                        for i in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print('Cancelling pipeline...')
+            self.cancel()
+            for thread in threads:
+                thread.join()
+            raise
+        self.seconds = time.time() - t1
+        self.report()
+        if self.error:
+            raise self.error
+        return self.results
+
+    def report(self):
+        print()
+        print(f'Pipeline {"FAILED" if self.error else "finished"} in {self.seconds:.1f} s, '
+              f'{self.source_items} items from source')
+        for stage in self.stages:
+            print(f'{stage.name}: {stage.items} done, {len(stage.failures)} failed, '
+                  f'{stage.workers} workers, busy {stage.busy:.1f} s')
+            for item, error in stage.failures:
+                print(f'    {item}: {error}')
+
+
+def bkf_pipeline(startdir=startdir, parse_workers=1, upload_workers=1, processes=False,
+                 recreate_tables=True, batch_size=None):
+    """конвейер загрузки xls в bkf. processes - парсить в пуле процессов (по процессу на воркер парсинга)"""
+    # конфиг и таблицы создаются параллельно с обходом дерева, парсинг ждет их готовности
+    config_ready = threading.Event()
+    config_box = {}
+
+    def load_config():
+        try:
+            config_box['config'] = GpXlsConfig(startdir, recreate_tables=recreate_tables)
+        except Exception as e:
+            # без конфига и таблиц грузить нечего: останавливаем весь конвейер, а не пропускаем файлы
+            logging.exception('CONFIG FAILED')
+            config_box['error'] = PipelineError('config', None, e)
+            pipeline.cancel(config_box['error'])
+        finally:
+            config_ready.set()
+
+    def get_config():
+        config_ready.wait()
+        if 'error' in config_box:
+            raise config_box['error']
+        return config_box['config']
+
+    executor_lock = threading.Lock()
+    executor_box = {}
+
+    def parse(filename):
+        config = get_config()
+        if not processes:
+            return GpXlsParser(filename, config).parse()
+        with executor_lock:
+            if 'executor' not in executor_box:
+                executor_box['executor'] = ProcessPoolExecutor(
+                    parse_workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+                    initializer=_init_parse_worker, initargs=(config,))
+        result = executor_box['executor'].submit(parse_file, filename).result()
+        if result.error:
+            raise ValueError(result.error)
+        return result.df
+
+    def open_connection():
+        return open_db()
+
+    def close_connection(state):
+        close_db(*state)
+
+    def upload(df, state):
+        cur, conn = state
+        get_checksums().add(df)
+        return upload_df_to_db(df, cur, conn, batch_size=batch_size)
+
+    pipeline = Pipeline(iter_filenames(startdir), [
+        Stage('parse', parse, workers=parse_workers, queue_size=2 * parse_workers, skip_errors=True),
+        Stage('upload', upload, workers=upload_workers, queue_size=2 * upload_workers,
+              setup=open_connection, teardown=close_connection),
+    ])
+    config_thread = threading.Thread(target=load_config, name='config')
+    config_thread.start()
+    try:
+        results = pipeline.run()
+    finally:
+        config_thread.join()
+        if 'executor' in executor_box:
+            executor_box['executor'].shutdown(cancel_futures=True)
+    show_1265_warnings([w for warnings_ in results for w in warnings_])
+    get_checksums().save()
+    return pipeline
+
+
+if __name__ == "__main__":
+    import sys
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    bkf_pipeline(parse_workers=int(options.get('parse-workers', 1)),
+                 upload_workers=int(options.get('upload-workers', 1)),
+                 processes='--processes' in sys.argv)
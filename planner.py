@@ -0,0 +1,113 @@
+"""План работы: список xls файлов с размерами и филиалами.
+Обход через os.scandir (размер берется из той же записи каталога, без лишнего stat),
+фильтр по настоящему расширению и BLACKLIST, временные файлы Excel (~$...) пропускаются.
+Файлы упорядочиваются от больших к меньшим: при параллельной обработке самый большой файл
+не попадает в конец и не оставляет один процесс работать в одиночку.
+Для раздачи файлов заранее заданному числу воркеров есть balance (жадный LPT).
+План можно сохранить в файл и в следующем запуске взять из него, не обходя дерево заново.
+"""
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from config import BLACKLIST
+
+XLS_EXTENSIONS = ('.xls', '.xlsx', '.xlsm')
+PLAN_FILE = '.work_plan.json'
+
+WorkItem = namedtuple('WorkItem', ['path', 'size', 'branch'])
+
+
+def is_xls(name):
+    return not name.startswith('~$') and os.path.splitext(name)[1].lower() in XLS_EXTENSIONS
+
+
+def not_in_blacklist(path):
+    for item in BLACKLIST:
+        if item in path:
+            return False
+    return True
+
+
+def iter_work(startdir, branch=None):
+    """отдает файлы по мере обхода дерева. branch - имя верхней папки под startdir"""
+    try:
+        entries = list(os.scandir(startdir))
+    except OSError as e:
+        logging.warning(f'CANNOT SCAN {startdir}: {e}')
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_work(entry.path, branch or entry.name)
+        elif entry.is_file() and is_xls(entry.name) and not_in_blacklist(entry.path):
+            # файлы прямо в startdir ни к какому филиалу не относятся
+            yield WorkItem(entry.path, entry.stat().st_size, branch)
+
+
+def largest_first(items):
+    return sorted(items, key=lambda item: (-item.size, item.path))
+
+
+def balance(items, workers):
+    """раскладывает файлы по workers спискам с близким суммарным размером:
+    очередной по убыванию размера файл уходит самому незагруженному воркеру"""
+    buckets = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for item in largest_first(items):
+        i = loads.index(min(loads))
+        buckets[i].append(item)
+        loads[i] += item.size
+    return buckets
+
+
+def save_plan(items, startdir, path=PLAN_FILE):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'startdir': startdir, 'created': time.time(), 'items': [item._asdict() for item in items]},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def load_plan(startdir, path=PLAN_FILE):
+    """план из файла, None, если его нет или он составлен для другой папки.
+    Пропавшие с тех пор файлы выкидываются, новые в план не попадают - для них нужен новый обход"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan['startdir'] != startdir:
+        logging.warning(f'PLAN {path} IS FOR {plan["startdir"]}, NOT {startdir}')
+        return None
+    items = [WorkItem(**item) for item in plan['items']]
+    existing = [item for item in items if os.path.exists(item.path)]
+    if len(existing) < len(items):
+        logging.warning(f'PLAN {path}: {len(items) - len(existing)} FILES ARE MISSING')
+    return existing
+
+
+def plan_work(startdir, plan_file=None, reuse=False):
+    """файлы от больших к меньшим. С plan_file план сохраняется, с reuse - сначала берется из него"""
+    items = load_plan(startdir, plan_file) if plan_file and reuse else None
+    if items is None:
+        items = largest_first(iter_work(startdir))
+        if plan_file:
+            save_plan(items, startdir, plan_file)
+    return items
+
+
+def show_plan(items, workers=None):
+    total = sum(item.size for item in items)
+    print(f'{len(items)} files, {total / 2**20:.1f} MB')
+    if workers:
+        for i, bucket in enumerate(balance(items, workers)):
+            print(f'worker {i}: {len(bucket)} files, {sum(item.size for item in bucket) / 2**20:.1f} MB')
+
+
+if __name__ == "__main__":
+    import sys
+    from config import startdir
+    # python planner.py [число воркеров] - составляет план, сохраняет его в PLAN_FILE и показывает раскладку
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    show_plan(plan_work(startdir, PLAN_FILE), int(args[0]) if args else None)
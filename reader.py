@@ -0,0 +1,191 @@
+"""Чтение xls/xlsx разными движками.
+Значения отдаются строками, как при pd.read_excel(dtype=str): пустые ячейки - None,
+целые числа - без '.0'. Номер строки везде совпадает с номером строки в xls минус 1.
+Движки:
+    xlrd - только старый .xls,
+    openpyxl - .xlsx/.xlsm в режиме read_only,
+    calamine - python-calamine (на Rust), если установлен, читает оба формата,
+    pandas - pd.read_excel с движком по умолчанию, только целиком (без потокового чтения).
+Для каждого формата берется самый быстрый из установленных движков: по замерам benchmark.py --engines
+(ENGINE_TIMINGS_FILE), а если замеров нет - по порядку ENGINE_PREFERENCE.
+Для филиала движок можно задать в config.READER_ENGINES.
+Потоковое чтение (iter_rows, iter_row_chunks) идет только через xlrd и openpyxl: calamine и pandas
+загружают лист целиком.
+"""
+import datetime
+import importlib.util
+import json
+import logging
+import os
+from itertools import islice
+
+import pandas as pd
+
+# замеры движков, которые пишет benchmark.py --engines
+ENGINE_TIMINGS_FILE = '.engine_timings.json'
+# движки по формату в порядке предпочтения, если замеров нет
+ENGINE_PREFERENCE = {
+    'xls': ['calamine', 'xlrd', 'pandas'],
+    'xlsx': ['calamine', 'openpyxl', 'pandas'],
+}
+# модуль, который должен быть установлен для движка
+ENGINE_MODULES = {
+    'xlrd': 'xlrd',
+    'openpyxl': 'openpyxl',
+    'calamine': 'python_calamine',
+    'pandas': 'pandas',
+}
+# движки, читающие лист по строкам: calamine и pandas держат в памяти весь лист,
+# поэтому потоковое чтение (iter_rows) всегда идет через них
+STREAMING_ENGINES = {
+    'xls': 'xlrd',
+    'xlsx': 'openpyxl',
+}
+
+_timings = None
+
+
+def _cell_to_str(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        # как у pandas: даты приходят как datetime
+        value = datetime.datetime.combine(value, datetime.time())
+    return str(value)
+
+
+def _iter_xlsx_rows(file):
+    import openpyxl
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = wb.worksheets[0]
+        # размеры листа, записанные в файле, бывают неверными - читаем до конца, как pandas
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(values_only=True):
+            yield [_cell_to_str(v) for v in row]
+    finally:
+        wb.close()
+
+
+def _xls_cell(value, cell_type, datemode):
+    """значение ячейки xlrd как у pandas: xlrd отдает даты числами, логические - 1/0, ошибки - кодами"""
+    import xlrd
+    if cell_type == xlrd.XL_CELL_DATE:
+        try:
+            value = xlrd.xldate_as_datetime(value, datemode)
+        except OverflowError:
+            return value
+        # нулевой день эпохи - это время без даты
+        if value.timetuple()[0:3] == ((1904, 1, 1) if datemode else (1899, 12, 31)):
+            return value.time()
+        return value
+    if cell_type == xlrd.XL_CELL_BOOLEAN:
+        return bool(value)
+    if cell_type == xlrd.XL_CELL_ERROR:
+        return None
+    return value
+
+
+def _iter_xls_rows(file):
+    import xlrd
+    wb = xlrd.open_workbook(file, on_demand=True)
+    try:
+        sheet = wb.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            yield [_cell_to_str(_xls_cell(v, t, wb.datemode))
+                   for v, t in zip(sheet.row_values(i), sheet.row_types(i))]
+    finally:
+        wb.release_resources()
+
+
+def _iter_calamine_rows(file):
+    from python_calamine import CalamineWorkbook
+    wb = CalamineWorkbook.from_path(file)
+    try:
+        # iter_rows, в отличие от to_python, не пропускает пустые строки в начале листа
+        for row in wb.get_sheet_by_index(0).iter_rows():
+            yield [_cell_to_str(v) for v in row]
+    finally:
+        wb.close()
+
+
+ROW_READERS = {
+    'xlrd': _iter_xls_rows,
+    'openpyxl': _iter_xlsx_rows,
+    'calamine': _iter_calamine_rows,
+}
+
+
+def file_format(file):
+    return 'xls' if os.path.splitext(file)[1].lower() == '.xls' else 'xlsx'
+
+
+def engine_available(engine):
+    return importlib.util.find_spec(ENGINE_MODULES[engine]) is not None
+
+
+def load_timings(path=ENGINE_TIMINGS_FILE):
+    """{формат: {движок: секунд на мегабайт}} из замеров бенчмарка"""
+    global _timings
+    if _timings is None:
+        _timings = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                _timings = json.load(f)['seconds_per_mb']
+    return _timings
+
+
+def pick_engine(file, override=None):
+    """самый быстрый установленный движок для формата файла, override - движок из конфига филиала"""
+    fmt = file_format(file)
+    if override:
+        if override not in ENGINE_PREFERENCE[fmt]:
+            raise ValueError(f'Engine {override} can not read {fmt} files')
+        return override
+    candidates = [e for e in ENGINE_PREFERENCE[fmt] if engine_available(e)]
+    measured = load_timings().get(fmt, {})
+    # сначала движки с замерами, от быстрого к медленному, потом остальные по порядку предпочтения
+    candidates.sort(key=lambda e: (e not in measured, measured.get(e, 0)))
+    return candidates[0]
+
+
+def _trim_row(row):
+    """убираем пустые ячейки в конце строки, как pandas"""
+    end = len(row)
+    while end and row[end - 1] is None:
+        end -= 1
+    return row[:end]
+
+
+def read_raw(file, engine=None):
+    """лист целиком в датафрейм строк без заголовка, как pd.read_excel(header=None, dtype=str)"""
+    engine = engine or pick_engine(file)
+    logging.debug(f'READING {file} WITH {engine}')
+    if engine == 'pandas':
+        return pd.read_excel(file, header=None, dtype=str)
+    rows = [_trim_row(row) for row in ROW_READERS[engine](file)]
+    # пустые строки в конце листа pandas тоже отбрасывает
+    while rows and not rows[-1]:
+        rows.pop()
+    # _cell_to_str уже отдает строки или None, пустые ячейки остаются пропусками
+    return pd.DataFrame(rows, dtype=object)
+
+
+def iter_rows(file, engine=None):
+    """отдает строки первого листа книги по одной. engine учитывается, только если он читает по строкам,
+    иначе берется потоковый движок формата (STREAMING_ENGINES), чтобы память не росла с размером файла"""
+    if engine not in STREAMING_ENGINES.values():
+        engine = STREAMING_ENGINES[file_format(file)]
+    return ROW_READERS[engine](file)
+
+
+def iter_row_chunks(file, chunk_size, engine=None):
+    """отдает строки первого листа списками по chunk_size строк"""
+    rows = iter_rows(file, engine)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
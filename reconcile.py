@@ -0,0 +1,173 @@
+"""Контрольные суммы файлов и сверка загруженного с распарсенным.
+Для каждого файла по мере того, как его датафреймы (целиком или кусками) уходят на загрузку,
+копятся: число строк, суммы decimal полей (в копейках, целыми - без ошибок округления)
+и сумма CRC32 ключевых полей строк - она не зависит от порядка строк.
+Суммы сохраняются в bkf_checksum_table. Сверка считает то же самое в БД одним агрегатным запросом
+на файл (по индексу `file`), без сравнения таблиц целиком, и печатает разошедшиеся файлы.
+
+    python reconcile.py
+"""
+import json
+import logging
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from config import bkf_table, bkf_checksum_table
+from db import open_db, close_db
+
+# поля, из которых складывается хэш строки
+KEY_FIELDS = ['bkf_inv_num', 'bkf_row_num']
+KEY_SEPARATOR = '|'
+# decimal поля парсер округляет до 2 знаков (GpXlsParser._init_df_types)
+DECIMAL_SCALE = 2
+
+
+def key_hash_sql():
+    parts = ', '.join(f"COALESCE({field}, '')" for field in KEY_FIELDS)
+    return f"SUM(CRC32(CONCAT_WS('{KEY_SEPARATOR}', {parts})))"
+
+
+class FileChecksum:
+    def __init__(self, rows=0, key_hash=0, sums=None):
+        self.rows = rows
+        self.key_hash = key_hash
+        # поле -> сумма в единицах последнего знака (int)
+        self.sums = sums or {}
+
+    def update(self, df: pd.DataFrame):
+        self.rows += len(df)
+        keys = [df[field].astype(object).where(df[field].notnull(), '').astype(str).tolist()
+                if field in df.columns else [''] * len(df) for field in KEY_FIELDS]
+        self.key_hash += sum(zlib.crc32(KEY_SEPARATOR.join(row).encode('utf-8')) for row in zip(*keys))
+        for field in df.columns:
+            if not pd.api.types.is_float_dtype(df[field].dtype):
+                continue
+            scaled = np.round(df[field].dropna().to_numpy() * 10 ** DECIMAL_SCALE).astype(np.int64)
+            # суммируем python int: на миллионах строк int64 может переполниться
+            self.sums[field] = self.sums.get(field, 0) + sum(scaled.tolist())
+
+    def as_row(self):
+        return self.rows, self.key_hash, json.dumps(self.sums, sort_keys=True)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['bks_rows'], int(row['bks_key_hash']), json.loads(row['bks_sums']))
+
+
+def file_key(df):
+    return int(df['bkf_branch_id'].iloc[0]), str(df['bkf_filename'].iloc[0])
+
+
+def store_checksum(cur, key, checksum: FileChecksum, table=bkf_checksum_table):
+    """пишет суммы файла без коммита, чтобы их можно было сохранить в одной транзакции с данными"""
+    cur.execute(f"""REPLACE INTO {table} (bks_branch_id, bks_filename, bks_rows, bks_key_hash, bks_sums)
+                    VALUES (%s, %s, %s, %s, %s)""", key + checksum.as_row())
+
+
+class ChecksumCollector:
+    """суммы по файлам за прогон: (id филиала, имя файла) -> FileChecksum"""
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def add(self, df: pd.DataFrame):
+        if not len(df):
+            return
+        key = file_key(df)
+        with self.lock:
+            checksum = self.files.setdefault(key, FileChecksum())
+            checksum.update(df)
+
+    def save(self, cur=None, conn=None, table=bkf_checksum_table):
+        if not self.files:
+            return
+        own_connection = cur is None
+        if own_connection:
+            cur, conn = open_db()
+        with self.lock:
+            for key, checksum in self.files.items():
+                store_checksum(cur, key, checksum, table)
+            conn.commit()
+            logging.info(f'CHECKSUMS OF {len(self.files)} FILES SAVED')
+            self.files = {}
+        if own_connection:
+            close_db(cur, conn)
+
+    def discard(self):
+        """собранные суммы не нужны: загрузка отменена"""
+        with self.lock:
+            self.files = {}
+
+
+_collector = ChecksumCollector()
+
+
+def get_checksums():
+    return _collector
+
+
+def db_checksum(cur, branch_id, filename, fields):
+    """то же, что FileChecksum, посчитанное в БД по строкам одного файла"""
+    sums = ''.join(f', SUM(`{field}`) AS `{field}`' for field in fields)
+    cur.execute(f"""SELECT COUNT(*) AS bks_rows, COALESCE({key_hash_sql()}, 0) AS bks_key_hash{sums}
+                    FROM {bkf_table} WHERE bkf_branch_id = %s AND bkf_filename = %s""", (branch_id, filename))
+    row = cur.fetchone()
+    scale = 10 ** DECIMAL_SCALE
+    return FileChecksum(int(row['bks_rows']), int(row['bks_key_hash']),
+                        {field: int(round((row[field] or 0) * scale)) for field in fields})
+
+
+def reconcile(cur=None):
+    """сверяет сохраненные суммы с БД, возвращает список расхождений"""
+    own_connection = cur is None
+    if own_connection:
+        cur, conn = open_db()
+    cur.execute(f"""SELECT * FROM {bkf_checksum_table}""")
+    stored = cur.fetchall()
+    drifts = []
+    for row in stored:
+        expected = FileChecksum.from_row(row)
+        actual = db_checksum(cur, row['bks_branch_id'], row['bks_filename'], list(expected.sums))
+        problems = []
+        if actual.rows != expected.rows:
+            problems.append(f'rows {actual.rows} != {expected.rows}')
+        if actual.key_hash != expected.key_hash:
+            problems.append('key fields differ')
+        for field, value in expected.sums.items():
+            if actual.sums[field] != value:
+                problems.append(f'sum of {field} {actual.sums[field] / 10 ** DECIMAL_SCALE} '
+                                f'!= {value / 10 ** DECIMAL_SCALE}')
+        if problems:
+            drifts.append({'branch_id': row['bks_branch_id'], 'filename': row['bks_filename'],
+                           'problems': problems})
+    # файлы в bkf, для которых сумм нет вовсе
+    cur.execute(f"""SELECT DISTINCT bkf_branch_id, bkf_filename FROM {bkf_table}""")
+    known = {(row['bks_branch_id'], row['bks_filename']) for row in stored}
+    for row in cur.fetchall():
+        if (row['bkf_branch_id'], row['bkf_filename']) not in known:
+            drifts.append({'branch_id': row['bkf_branch_id'], 'filename': row['bkf_filename'],
+                           'problems': ['no checksum stored']})
+    if own_connection:
+        close_db(cur, conn)
+    show_drifts(drifts, len(stored))
+    return drifts
+
+
+def show_drifts(drifts, checked):
+    print(f'Reconciliation: {checked} files checked, {len(drifts)} drifted')
+    if drifts:
+        logging.warning(f'{len(drifts)} FILES IN {bkf_table} DO NOT MATCH PARSED DATA')
+        print('*' * 100)
+        for d in drifts:
+            print(d['branch_id'], d['filename'], '; '.join(d['problems']))
+        print('*' * 100)
+
+
+if __name__ == "__main__":
+    t1 = time.time()
+    reconcile()
+    print('Время выполнения', time.time() - t1)
@@ -0,0 +1,130 @@
+"""Куда складывать распарсенные датафреймы.
+Синк - вызываемый объект sink(df) с методом close(), его можно передать в main(upload=...).
+MySQLSink - обертка над существующими upload_df / upload_df_infile.
+ParquetSink пишет сводный набор данных bkf в parquet, разбитый по филиалам
+(папки bkf_branch_id=N, как принято в hive/arrow; в самих файлах этого столбца нет),
+без загрузки в БД: прогон упирается только в парсинг.
+Типы столбцов берутся из TYPE в fields.csv, так что у всех частей одна схема со всеми полями bkf,
+поля, которых нет в раскладке филиала, - пустые, как и в таблице MySQL.
+Режимы: append - каждый файл дописывается отдельной частью; replace - при первой записи в филиал
+за прогон его старые части удаляются (перезагрузка филиала целиком).
+"""
+import logging
+import os
+import re
+import shutil
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset  # noqa: F401 (pa.dataset)
+import pyarrow.parquet as pq
+
+from config import bkf_table
+
+PARQUET_DIR = f'{bkf_table}_parquet'
+PARTITION_FIELD = 'bkf_branch_id'
+# служебные поля, которые добавляет GpXlsParser._add_service_fields
+SERVICE_FIELDS = [
+    ('bkf_branch_id', pa.int32()),
+    ('bkf_row_num', pa.int32()),
+    ('bkf_filename', pa.string()),
+]
+
+
+def arrow_type(sql_type):
+    """тип arrow для типа MySQL из fields.csv"""
+    sql_type = sql_type.lower().strip()
+    decimal = re.match(r'decimal\((\d+),\s*(\d+)\)', sql_type)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    base = sql_type.split('(')[0].replace('unsigned', '').strip()
+    if base == 'bigint':
+        return pa.int64()
+    if base.endswith('int'):
+        return pa.int32()
+    if base in ('float', 'double'):
+        return pa.float64()
+    return pa.string()
+
+
+def bkf_schema(config):
+    fields = [pa.field(field, arrow_type(sql_type)) for field, sql_type in config.fields['TYPE'].items()]
+    return pa.schema(fields + [pa.field(name, type_) for name, type_ in SERVICE_FIELDS])
+
+
+class MySQLSink:
+    def __init__(self, upload=None):
+        if upload is None:
+            from main import upload_df as upload
+        self.upload = upload
+
+    def __call__(self, df):
+        self.upload(df)
+
+    def close(self):
+        pass
+
+
+class ParquetSink:
+    def __init__(self, config, root=PARQUET_DIR, mode='append'):
+        if mode not in ('append', 'replace'):
+            raise ValueError(f'Unknown mode {mode}')
+        self.root = root
+        self.mode = mode
+        schema = bkf_schema(config)
+        # id филиала хранится в имени папки
+        self.schema = schema.remove(schema.get_field_index(PARTITION_FIELD))
+        # филиалы, уже очищенные в этом прогоне (replace)
+        self.replaced = set()
+        self.rows = 0
+        self.parts = 0
+        os.makedirs(root, exist_ok=True)
+
+    def partition_dir(self, branch_id):
+        return os.path.join(self.root, f'{PARTITION_FIELD}={branch_id}')
+
+    def to_table(self, df):
+        """датафрейм в таблицу со схемой bkf: недостающие поля - null, типы по fields.csv"""
+        columns = []
+        for field in self.schema:
+            if field.name in df.columns:
+                array = pa.array(df[field.name], from_pandas=True)
+                if pa.types.is_dictionary(array.type):
+                    array = array.dictionary_decode()
+                columns.append(pc.cast(array, field.type))
+            else:
+                columns.append(pa.nulls(len(df), field.type))
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def __call__(self, df):
+        if df is None or df.empty:
+            return
+        for branch_id, part in df.groupby(PARTITION_FIELD, observed=True, sort=False):
+            self.write_partition(int(branch_id), part)
+
+    def write_partition(self, branch_id, df):
+        directory = self.partition_dir(branch_id)
+        if self.mode == 'replace' and branch_id not in self.replaced:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.replaced.add(branch_id)
+        os.makedirs(directory, exist_ok=True)
+        # пишем во временный файл с точкой в начале имени (arrow такие пропускает):
+        # читатели набора не увидят недописанную часть
+        name = f'part-{uuid.uuid4().hex}.parquet'
+        tmp = os.path.join(directory, f'.{name}.tmp')
+        pq.write_table(self.to_table(df), tmp)
+        os.replace(tmp, os.path.join(directory, name))
+        self.rows += len(df)
+        self.parts += 1
+
+    def close(self):
+        logging.info(f'PARQUET: {self.rows} ROWS IN {self.parts} PARTS WRITTEN TO {self.root}')
+        print(f'Parquet: {self.rows} rows in {self.parts} parts written to {self.root}')
+
+
+def read_dataset(root=PARQUET_DIR, branch_id=None):
+    """набор целиком или один филиал в датафрейм"""
+    filters = [(PARTITION_FIELD, '=', branch_id)] if branch_id is not None else None
+    partitioning = pa.dataset.partitioning(pa.schema([(PARTITION_FIELD, pa.int32())]), flavor='hive')
+    return pq.read_table(root, partitioning=partitioning, filters=filters).to_pandas()
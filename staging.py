@@ -0,0 +1,126 @@
+"""Загрузка через промежуточную таблицу.
+Обычный прогон удаляет bkf_table в начале, и все время загрузки читатели видят пустую
+или недогруженную таблицу, а каждый батч коммитится в таблицу со всеми индексами.
+Здесь данные идут в свежую bkf_staging_table без вторичных индексов, в одной сессии с отключенными
+unique_checks/foreign_key_checks и одним коммитом на файл. Индексы строятся один раз после загрузки
+(сортировкой, а не вставкой по строке), затем RENAME TABLE атомарно подменяет bkf_table.
+Контрольные суммы файлов (reconcile.py) пишутся в свою промежуточную таблицу и подменяются
+тем же RENAME TABLE: bkf_checksum_table всегда описывает живую bkf_table, без сумм удаленных файлов.
+Если загрузка упала, bkf_table и bkf_checksum_table остаются прежними.
+
+    python staging.py [--bulk]
+"""
+import logging
+import time
+
+from config import GpXlsConfig, BranchConfig, startdir, gp_branches_table, bkf_table, bkf_staging_table, \
+    bkf_old_table, bkf_secondary_keys, bkf_checksum_table, bkf_checksum_staging_table, bkf_checksum_old_table
+from db import open_db, close_db
+from reconcile import get_checksums
+from main import main, upload_df_to_db, show_1265_warnings
+
+# настройки сессии на время загрузки
+BULK_SESSION_SETTINGS = [
+    'SET SESSION unique_checks = 0',
+    'SET SESSION foreign_key_checks = 0',
+    'SET SESSION autocommit = 0',
+]
+
+
+def table_exists(cur, table):
+    cur.execute('SHOW TABLES LIKE %s', (table,))
+    return cur.fetchone() is not None
+
+
+class StagingLoad:
+    """вызывается как upload(df) в main(), грузит все в одном соединении"""
+    def __init__(self, startdir=startdir, table=bkf_table, staging=bkf_staging_table, bulk=False,
+                 batch_size=None):
+        self.table = table
+        self.staging = staging
+        self.bulk = bulk
+        self.batch_size = batch_size
+        # gp_branches не пересоздаем, только дописываем новые филиалы: ее читают вместе с bkf_table
+        branch_config = BranchConfig(startdir, gp_branches_table)
+        branch_config.create_branch_table(drop=False)
+        branch_config.fill_gp_branches()
+        self.config = GpXlsConfig(startdir, recreate_tables=False)
+        logging.info(f'CREATING STAGING TABLE {staging}')
+        self.config.create_bkf_table(drop=True, table=staging, secondary_keys=False)
+        self.config.create_checksum_table(drop=True, table=bkf_checksum_staging_table)
+        self.cur, self.conn = open_db()
+        for SQL in BULK_SESSION_SETTINGS:
+            self.cur.execute(SQL)
+        self.rows = 0
+
+    def __call__(self, df):
+        if self.bulk:
+            from bulk import upload_df_infile
+            upload_df_infile(df, self.cur, self.conn, table=self.staging)
+        else:
+            get_checksums().add(df)
+            warnings_ = upload_df_to_db(df, self.cur, self.conn, self.staging, commit=False,
+                                        batch_size=self.batch_size)
+            self.conn.commit()
+            show_1265_warnings(warnings_)
+        self.rows += len(df)
+
+    def add_secondary_keys(self):
+        if not bkf_secondary_keys:
+            return
+        t1 = time.time()
+        logging.info(f'ADDING SECONDARY KEYS TO {self.staging}')
+        keys = ', '.join(f'ADD {key}' for key in bkf_secondary_keys)
+        self.cur.execute(f'ALTER TABLE `{self.staging}` {keys}')
+        print(f'Secondary keys added in {time.time() - t1:.1f} s')
+
+    def swap(self):
+        """подмена одним RENAME TABLE: читатели видят либо старые таблицы, либо новые целиком"""
+        pairs = [(self.table, bkf_old_table, self.staging), (bkf_checksum_table, bkf_checksum_old_table,
+                                                            bkf_checksum_staging_table)]
+        renames, old = [], []
+        for live, previous, staging in pairs:
+            if table_exists(self.cur, live):
+                self.cur.execute(f'DROP TABLE IF EXISTS `{previous}`')
+                renames.append(f'`{live}` TO `{previous}`')
+                old.append(previous)
+            renames.append(f'`{staging}` TO `{live}`')
+        self.cur.execute(f'RENAME TABLE {", ".join(renames)}')
+        for previous in old:
+            self.cur.execute(f'DROP TABLE `{previous}`')
+        logging.info(f'{self.staging} SWAPPED IN AS {self.table}')
+
+    def finish(self):
+        self.conn.commit()
+        self.add_secondary_keys()
+        get_checksums().save(self.cur, self.conn, bkf_checksum_staging_table)
+        self.swap()
+        close_db(self.cur, self.conn)
+        print(f'{self.rows} rows loaded into {self.table}')
+
+    def abort(self):
+        """загрузка не удалась: bkf_table не трогаем, staging удаляем"""
+        self.conn.rollback()
+        get_checksums().discard()
+        self.cur.execute(f'DROP TABLE IF EXISTS `{self.staging}`')
+        self.cur.execute(f'DROP TABLE IF EXISTS `{bkf_checksum_staging_table}`')
+        close_db(self.cur, self.conn)
+
+
+def load_with_staging(processes=None, bulk=False):
+    load = StagingLoad(bulk=bulk)
+    try:
+        main(processes, upload=load, recreate_tables=False, save_checksums=False)
+    except BaseException:
+        logging.exception('STAGING LOAD FAILED, LIVE TABLE IS UNCHANGED')
+        load.abort()
+        raise
+    load.finish()
+
+
+if __name__ == "__main__":
+    import sys
+    t1 = time.time()
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    load_with_staging(int(args[0]) if args else None, bulk='--bulk' in sys.argv)
+    print('Время выполнения', time.time() - t1)
@@ -0,0 +1,26 @@
+import os
+import sys
+import types
+
+# модули проекта лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _offline_db(*args, **kwargs):
+    raise RuntimeError('tests run without a database: db.py is not installed')
+
+
+def _install_stand_in(name, **attrs):
+    """локальные настройки (secure.py, db.py) в репозиторий не входят. Без них config не импортируется,
+    поэтому подставляем заглушки: имена таблиц и папок для офлайн-конфига, БД недоступна"""
+    try:
+        __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+_install_stand_in('secure', gp_branches_table='gp_branches', bkf_table='bkf', startdir=os.getcwd(), BLACKLIST=[],
+                  bkf_table_comment='', branch_table_comment='')
+_install_stand_in('db', open_db=_offline_db, close_db=_offline_db)
@@ -0,0 +1,126 @@
+"""TSV для LOAD DATA LOCAL INFILE и разбор предупреждений сервера.
+Проверка на настоящей БД включается переменной окружения BKF_TEST_DB=1: нужен локальный MySQL
+или MariaDB из db.open_db с local_infile, тест создает и удаляет свою таблицу bkf_test_infile."""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# MySQLdb (mysqlclient) нужен bulk.py уже при импорте
+pytest.importorskip('MySQLdb')
+
+from bulk import NULL, write_tsv, get_infile_warnings, upload_df_infile  # noqa: E402
+
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\', '0': '\0'}
+TRICKY = ['tab\there', 'new\nline', 'cr\rlf', 'bk\\slash', '\\N', 'N', '', 'ё и "кавычки"', None]
+
+
+def read_field(field):
+    """разбор поля так, как его читает LOAD DATA с ESCAPED BY '\\\\'"""
+    if field == NULL:
+        return None
+    out, chars = [], iter(field)
+    for char in chars:
+        out.append(ESCAPES.get(next(chars), '') if char == '\\' else char)
+    return ''.join(out)
+
+
+def read_tsv(text):
+    return [[read_field(field) for field in line.split('\t')] for line in text.split('\n')[:-1]]
+
+
+def frame():
+    return pd.DataFrame({
+        'bkf_os_name': pd.Series(TRICKY, dtype=object),
+        'bkf_init_cost': [1.5, np.nan, 0.1, -2.25, 1e12, 3.0, 0.0, 12345.67, np.nan],
+        'bkf_row_num': range(8, 8 + len(TRICKY)),
+        'bkf_branch_id': [1] * len(TRICKY),
+        'bkf_filename': ['book.xlsx'] * len(TRICKY),
+    })
+
+
+def test_write_tsv_round_trip():
+    df = frame()
+    f = io.StringIO()
+    write_tsv(df, f)
+    rows = read_tsv(f.getvalue())
+    assert len(rows) == len(df)
+    assert [row[0] for row in rows] == TRICKY
+    costs = [None if row[1] is None else float(row[1]) for row in rows]
+    assert costs == [None if np.isnan(v) else v for v in df['bkf_init_cost']]
+    assert [int(row[2]) for row in rows] == df['bkf_row_num'].tolist()
+
+
+def test_write_tsv_category_and_string_dtypes():
+    df = frame()
+    df['bkf_os_name'] = df['bkf_os_name'].astype('category')
+    df['bkf_filename'] = df['bkf_filename'].astype(str)
+    f = io.StringIO()
+    write_tsv(df, f)
+    rows = read_tsv(f.getvalue())
+    assert [row[0] for row in rows] == TRICKY
+    assert {row[4] for row in rows} == {'book.xlsx'}
+
+
+class WarningsCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, SQL):
+        assert SQL == 'SHOW WARNINGS'
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.mark.parametrize('as_dict', [False, True])
+def test_infile_warnings_point_to_dataframe_rows(as_dict):
+    df = frame()
+    rows = [('Warning', 1265, "Data truncated for column 'bkf_os_name' at row 2"),
+            ('Warning', 1265, "Data truncated for column 'bkf_init_cost' at row 5")]
+    if as_dict:
+        rows = [dict(zip(('Level', 'Code', 'Message'), row)) for row in rows]
+    warnings_ = get_infile_warnings(df, WarningsCursor(rows))
+    # номер строки в предупреждении - номер строки TSV, с 1
+    assert [(w['row_num'], w['field'], w['file_row_num']) for w in warnings_] == \
+        [(2, 'bkf_os_name', 9), (5, 'bkf_init_cost', 12)]
+    assert warnings_[0]['value'] == 'new\nline'
+
+
+def test_unexpected_warnings_are_skipped():
+    rows = [('Warning', 1366, "Incorrect string value: '\\xF0' for column 'bkf_os_name' at row 1")]
+    assert get_infile_warnings(frame(), WarningsCursor(rows)) == []
+
+
+@pytest.mark.skipif(os.environ.get('BKF_TEST_DB') != '1', reason='set BKF_TEST_DB=1 to test against a local DB')
+def test_load_data_infile_on_local_db():
+    from db import open_db, close_db
+    table = 'bkf_test_infile'
+    cur, conn = open_db()
+    try:
+        cur.execute(f'DROP TABLE IF EXISTS `{table}`')
+        cur.execute(f"""CREATE TABLE `{table}` (
+                        `bkf_id` int NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                        `bkf_os_name` varchar(9) DEFAULT NULL,
+                        `bkf_init_cost` decimal(17,2) DEFAULT NULL,
+                        `bkf_row_num` int DEFAULT NULL,
+                        `bkf_branch_id` int DEFAULT NULL,
+                        `bkf_filename` varchar(255) DEFAULT NULL
+                        ) DEFAULT CHARSET=utf8""")
+        df = frame()
+        warnings_ = upload_df_infile(df, cur, conn, table=table)
+        cur.execute(f'SELECT * FROM `{table}` ORDER BY bkf_id')
+        loaded = cur.fetchall()
+        loaded = [dict(zip(['bkf_id'] + list(df.columns), row)) if not isinstance(row, dict) else row
+                  for row in loaded]
+        assert [row['bkf_row_num'] for row in loaded] == df['bkf_row_num'].tolist()
+        # длиннее varchar(9) только 'ё и "кавычки"' - его и должно обрезать
+        assert [(w['row_num'], w['field']) for w in warnings_] == [(8, 'bkf_os_name')]
+        assert [row['bkf_os_name'] for row in loaded][:7] == TRICKY[:7]
+        assert loaded[-1]['bkf_os_name'] is None
+    finally:
+        cur.execute(f'DROP TABLE IF EXISTS `{table}`')
+        conn.commit()
+        close_db(cur, conn)
@@ -0,0 +1,45 @@
+import math
+
+import pandas as pd
+import pytest
+
+from xlsparser import parse_decimal
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('1234.56', 1234.56),
+    ('1 234,56', 1234.56),
+    ('1\xa0234\xa0567,5', 1234567.5),
+    ('  12 ', 12.0),
+    ('-5,5', -5.5),
+    ('0', 0.0),
+    ('1e3', 1000.0),
+])
+def test_parsed(text, expected):
+    values, failed = parse_decimal(pd.Series([text], dtype=object))
+    assert values.iloc[0] == pytest.approx(expected)
+    assert not failed.iloc[0]
+
+
+@pytest.mark.parametrize('text', [None, '', ' ', '\xa0'])
+def test_empty_is_nan_not_error(text):
+    values, failed = parse_decimal(pd.Series([text], dtype=object))
+    assert math.isnan(values.iloc[0])
+    assert not failed.iloc[0]
+
+
+@pytest.mark.parametrize('text', ['abc', '12,34,56', '1.2.3', 'б/н'])
+def test_garbage_is_reported(text):
+    values, failed = parse_decimal(pd.Series([text], dtype=object))
+    assert math.isnan(values.iloc[0])
+    assert failed.iloc[0]
+
+
+def test_mixed_column_keeps_index_and_dtype():
+    series = pd.Series(['1,5', None, '2', 'x', '3 000'], index=[10, 11, 12, 13, 14], dtype=str)
+    values, failed = parse_decimal(series)
+    assert values.dtype == float
+    assert list(values.index) == list(series.index)
+    assert values[[10, 12, 14]].tolist() == [1.5, 2.0, 3000.0]
+    assert values[[11, 13]].isnull().all()
+    assert failed.tolist() == [False, False, False, True, False]
@@ -0,0 +1,65 @@
+"""Парсинг синтетических файлов benchmark.generate_tree: пустые строки и заголовок отчета над таблицей,
+шапка из двух строк с объединенной ячейкой, строка нумерации столбцов, строки "Итого",
+альтернативная конфигурация филиала (//add)."""
+import os
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import benchmark
+from xlsparser import GpXlsParser
+
+ROWS = 1200
+SERVICE_FIELDS = ['bkf_row_num', 'bkf_branch_id', 'bkf_filename']
+
+
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    startdir = str(tmp_path_factory.mktemp('startdir'))
+    files = benchmark.generate_tree(startdir, ROWS, 1, ['xlsx'])
+    return files, benchmark.offline_config(startdir)
+
+
+def plain(df):
+    """типы столбцов зависят от сжатия (category выбирается по данным), сравниваем значения"""
+    return df.astype(object).where(df.notnull(), None).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('branch', [benchmark.MAIN_BRANCH, benchmark.ALTER_BRANCH])
+def test_columns(tree, branch):
+    files, config = tree
+    file = next(f for f in files if os.sep + branch + os.sep in f)
+    df = GpXlsParser(file, config).parse()
+    assert list(df.columns) == list(benchmark.FIELDS) + SERVICE_FIELDS
+    assert len(df) == ROWS
+    assert (df['bkf_branch_id'] == config.branches_indexes[branch]).all()
+
+
+def test_row_num_points_to_sheet_row(tree):
+    files, config = tree
+    for file in files:
+        df = GpXlsParser(file, config).parse()
+        sheet = openpyxl.load_workbook(file, read_only=True).worksheets[0]
+        rows = {i: row for i, row in enumerate(sheet.iter_rows(values_only=True), start=1)}
+        for row_num, inv_num, name in zip(df['bkf_row_num'], df['bkf_inv_num'], df['bkf_os_name']):
+            assert rows[row_num][0] == inv_num
+            assert rows[row_num][1] == name
+
+
+def test_trash_rows_and_autofill(tree):
+    files, config = tree
+    df = GpXlsParser(files[0], config).parse()
+    assert not df['bkf_os_name'].isin(['Итого']).any()
+    assert df['bkf_inv_num'].notnull().all()
+    # код класса заполнен только в каждой 7-й строке, остальные заполняются сверху
+    assert df['bkf_class_os_code'].notnull().all()
+    assert df['bkf_init_cost'].dtype == float
+
+
+def test_parse_chunks_matches_parse(tree):
+    files, config = tree
+    for file in files:
+        whole = GpXlsParser(file, config).parse()
+        chunks = pd.concat(list(GpXlsParser(file, config).parse_chunks(250)))
+        pd.testing.assert_frame_equal(plain(whole), plain(chunks))
@@ -1,52 +1,49 @@
 """ Это реализация парсинга, в которой загрузка в базу данных делается отдельным тредом.
 Выигрыш во времени на удаленной БД - примерно 40%
 Пробовал и параллелить сам парсинг с помощью тред пула - выигрыша во времени нет
+Очередь батчей ограничена по размеру, так что парсер ждет, если БД не успевает.
+С ключом --stream файлы парсятся и грузятся кусками, так что память не зависит от размера файла.
+С ключом --workers=N в БД пишут N тредов, каждый со своим соединением.
 """
-import logging
-import threading
+from main import get_filenames, startdir, XlsIterator, upload_df, upload_file_by_chunks
+from uploader import UploadPool
+from reconcile import get_checksums
+from xlsparser import GpXlsParser
 
-from main import upload_batch, get_filenames, startdir, XlsIterator, upload_df, show_1265_warnings
-from db import open_db, close_db
-from queue import Queue
-
-
-def upload_worker(queue: Queue):
-    cur, conn = open_db()
-    print('Worker started, waiting for data...')
-    SQL, batch = queue.get()
-    fname = batch[0]['bkf_filename'] if batch else None
-    print(f'WORKER: Uploading {fname} to DB....')
-    while batch:
-        old_fname = fname
-        fname = batch[0]['bkf_filename']
-        if fname != old_fname:
-            print(f'WORKER: Uploading {fname} to DB....')
-        warnings_ = upload_batch(SQL, batch, cur, conn)
-        SQL, batch = queue.get()
-        show_1265_warnings(warnings_)
-    close_db(cur, conn)
+# сколько батчей может лежать в очереди загрузки
+QUEUE_SIZE = 20
+# число тредов загрузки, можно задать ключом --workers=N
+UPLOAD_WORKERS = 1
 
 
 if __name__ == "__main__":
+    import sys
     import time
+    stream = '--stream' in sys.argv
+    workers = UPLOAD_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            workers = int(arg.split('=')[1])
     t1 = time.time()
     print('Getting filenames...')
     filenames = get_filenames(startdir)
     print('Initializing parser')
     walkall = XlsIterator(filenames, 0)
 
-    # Создаем очередь для батчей загрузки в бд, ее будет разбирать отдельный тред
-    batch_queue = Queue()
-    upload_thread = threading.Thread(target=upload_worker, args=(batch_queue,))
-    upload_thread.daemon = True
-    print('Start upload to db thread...')
-    upload_thread.start()
-
-    for df in walkall:
-        upload_df(df, batch_queue)
-
-    print('Кладем пустой batch')
-    batch_queue.put(('', []))
-    upload_thread.join()
+    # Создаем пул тредов загрузки в бд с общей ограниченной очередью батчей
+    pool = UploadPool(workers, QUEUE_SIZE).start()
+
+    try:
+        if stream:
+            for filename in walkall.filenames:
+                upload_file_by_chunks(GpXlsParser(filename, walkall.config), pool)
+        else:
+            for df in walkall:
+                upload_df(df, pool)
+    finally:
+        print('Останавливаем треды загрузки')
+        pool.close()
+    pool.report()
+    get_checksums().save()
     t2 = time.time()
     print('Время выполнения', t2-t1)
@@ -0,0 +1,157 @@
+"""Пул тредов загрузки в БД.
+Каждый тред держит свое соединение из db.open_db и разбирает общую очередь батчей
+(SQL, columns, batch), которую наполняет upload_df(df, queue=pool).
+Очередь ограничена по размеру: если БД не успевает, парсер блокируется на put,
+и батчи не копятся в памяти. Остановка - по одному None на каждый тред.
+Размер батчей подбирает один на весь пул AdaptiveBatchSize (batching.py): парсер режет по нему батчи
+(upload_df -> fit), треды сообщают ему время загрузки каждого батча, а max_allowed_packet
+спрашивается при старте пула.
+Статистика по тредам и все 1265 варнинги собираются и печатаются в конце.
+Если тред не смог подключиться к БД или упал, пул помечается сломанным: put и close
+не ждут вечно на заполненной очереди, а бросают UploadPoolError.
+"""
+import logging
+import threading
+import time
+from queue import Queue, Full
+
+from batching import AdaptiveBatchSize, max_allowed_packet, estimate_row_bytes
+from db import open_db, close_db
+from main import upload_batch, show_1265_warnings
+
+# как часто put/close, ждущие места в очереди, проверяют, живы ли треды, секунд
+PUT_TIMEOUT = 0.5
+
+
+class UploadPoolError(Exception):
+    pass
+
+
+class WorkerStats:
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.warnings = []
+        self.errors = []
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class UploadPool:
+    def __init__(self, workers=4, queue_size=50):
+        self.queue = Queue(queue_size)
+        self.stats = [WorkerStats(f'upload-{i}') for i in range(workers)]
+        # daemon - зависший тред не держит интерпретатор после ошибки в основном потоке
+        self.threads = [threading.Thread(target=self._worker, args=(stats,), name=stats.name, daemon=True)
+                        for stats in self.stats]
+        self.failed = threading.Event()
+        self.error = None
+        self.sizer = AdaptiveBatchSize()
+        self.sizer_lock = threading.Lock()
+
+    def start(self):
+        print(f'Start {len(self.threads)} upload to db threads...')
+        cur, conn = open_db()
+        try:
+            self.sizer.fit(0, max_allowed_packet(cur))
+        finally:
+            close_db(cur, conn)
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _fail(self, stats: WorkerStats, error):
+        logging.exception(f'{stats.name}: UPLOAD THREAD FAILED')
+        stats.errors.append(error)
+        self.error = error
+        self.failed.set()
+
+    def _check(self):
+        if self.failed.is_set():
+            raise UploadPoolError(f'Upload thread failed: {self.error!r}') from self.error
+
+    def fit(self, df):
+        """размер батчей для очередного датафрейма: ограничен по max_allowed_packet и длине его строк"""
+        with self.sizer_lock:
+            return self.sizer.fit(estimate_row_bytes(df))
+
+    def put(self, item):
+        """кладет (SQL, columns, batch) в очередь, ждет, если очередь заполнена,
+        и бросает UploadPoolError, если пул сломан"""
+        while True:
+            self._check()
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT)
+                return
+            except Full:
+                continue
+
+    def _worker(self, stats: WorkerStats):
+        try:
+            cur, conn = open_db()
+        except Exception as e:
+            self._fail(stats, e)
+            return
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                SQL, columns, batch = item
+                t1 = time.time()
+                try:
+                    stats.warnings += upload_batch(SQL, columns, batch, cur, conn)
+                except Exception as e:
+                    logging.exception(f'{stats.name}: ERROR WHILE UPLOADING BATCH')
+                    conn.rollback()
+                    stats.errors.append(e)
+                else:
+                    stats.rows += len(batch)
+                    stats.batches += 1
+                    with self.sizer_lock:
+                        self.sizer.record(len(batch), time.time() - t1)
+                finally:
+                    stats.seconds += time.time() - t1
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            close_db(cur, conn)
+
+    def close(self):
+        """ждет, пока очередь разберут, и останавливает треды.
+        Если какой-то тред упал, после остановки остальных бросает UploadPoolError"""
+        stops = len(self.threads)
+        while stops:
+            try:
+                self.queue.put(None, timeout=PUT_TIMEOUT)
+                stops -= 1
+            except Full:
+                # очередь некому разбирать
+                if not any(thread.is_alive() for thread in self.threads):
+                    break
+        for thread in self.threads:
+            thread.join()
+        self._check()
+
+    @property
+    def warnings(self):
+        return [w for stats in self.stats for w in stats.warnings]
+
+    @property
+    def errors(self):
+        return [e for stats in self.stats for e in stats.errors]
+
+    def report(self):
+        print()
+        for stats in self.stats:
+            print(f'{stats.name}: {stats.rows} rows in {stats.batches} batches, '
+                  f'{stats.seconds:.1f} s, {stats.rows_per_second:.0f} rows/s, '
+                  f'{len(stats.warnings)} warnings, {len(stats.errors)} errors')
+        self.sizer.report('upload pool')
+        show_1265_warnings(self.warnings)
+        if self.errors:
+            logging.warning(f'{len(self.errors)} BATCHES WAS NOT UPLOADED')
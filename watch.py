@@ -0,0 +1,231 @@
+"""Загрузка изменений по мере их появления: демон следит за папками филиалов и перезаливает
+только измененный файл (как incremental.load_file - его строки и запись в манифесте в одной транзакции).
+Изменения ловятся через inotify (пакет inotify_simple), если он установлен, иначе - опросом дерева
+раз в POLL_INTERVAL секунд. Файл берется в работу, когда он DEBOUNCE_SECONDS не менялся
+и его размер и время изменения остались прежними: недописанный файл не парсится.
+Конфиг полей, соединение с БД и индекс номеров держатся между событиями; при правке fields.csv
+или появлении нового филиала конфиг перечитывается.
+При старте догружается все, что изменилось, пока демон не работал (как incremental.py).
+
+    python watch.py [--poll] [--duplicates=branch|global]
+"""
+import logging
+import os
+import time
+
+import MySQLdb
+
+from config import GpXlsConfig, startdir, config_file, bkf_manifest_table
+from db import open_db, close_db
+from duplicates import InventoryIndex
+from incremental import get_manifest, plan_delta, check_filename_collisions, load_file, remove_file, \
+    relative_path
+from main import get_filenames
+from planner import iter_work, is_xls, not_in_blacklist
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# сколько секунд файл не должен меняться, чтобы его можно было парсить
+DEBOUNCE_SECONDS = 2.0
+# период опроса дерева, если inotify недоступен
+POLL_INTERVAL = 2.0
+# сколько ждать событий inotify за один заход, секунд
+EVENT_TIMEOUT = 0.5
+
+
+def file_state(path):
+    """размер и время изменения файла, None - файла нет"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class PollingWatcher:
+    """сравнивает размеры и времена изменения файлов с прошлым обходом"""
+    def __init__(self, startdir, interval=POLL_INTERVAL):
+        self.startdir = startdir
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {item.path: file_state(item.path) for item in iter_work(self.startdir)}
+        snapshot[os.path.join(self.startdir, config_file)] = file_state(os.path.join(self.startdir, config_file))
+        return snapshot
+
+    def changes(self):
+        time.sleep(self.interval)
+        snapshot = self.scan()
+        changed = {path for path, state in snapshot.items() if self.snapshot.get(path) != state}
+        changed |= set(self.snapshot) - set(snapshot)
+        self.snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher:
+    """inotify на каждую папку дерева, новые папки добавляются по мере появления"""
+    def __init__(self, startdir, timeout=EVENT_TIMEOUT):
+        self.timeout = timeout
+        self.mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM
+                     | flags.DELETE)
+        self.inotify = INotify()
+        self.dirs = {}  # wd -> папка
+        self.add_tree(startdir)
+
+    def add_tree(self, path):
+        for dirpath, _, _ in os.walk(path):
+            self.dirs[self.inotify.add_watch(dirpath, self.mask)] = dirpath
+
+    def changes(self):
+        changed = set()
+        for event in self.inotify.read(timeout=int(self.timeout * 1000)):
+            if event.mask & flags.IGNORED:
+                # папка удалена, ее watch снят
+                self.dirs.pop(event.wd, None)
+                continue
+            directory = self.dirs.get(event.wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    # файлы могли попасть в папку раньше, чем на нее встал watch
+                    self.add_tree(path)
+                    changed |= {item.path for item in iter_work(path)}
+                continue
+            changed.add(path)
+        return changed
+
+
+def make_watcher(startdir, polling=False):
+    if polling or INotify is None:
+        logging.info(f'WATCHING {startdir} BY POLLING EVERY {POLL_INTERVAL} S')
+        return PollingWatcher(startdir)
+    logging.info(f'WATCHING {startdir} WITH INOTIFY')
+    return InotifyWatcher(startdir)
+
+
+class Debouncer:
+    """отдает файлы, которые quiet секунд не менялись"""
+    def __init__(self, quiet=DEBOUNCE_SECONDS):
+        self.quiet = quiet
+        self.pending = {}  # путь -> (время последнего изменения, file_state)
+
+    def touch(self, paths):
+        now = time.monotonic()
+        for path in paths:
+            self.pending[path] = now, file_state(path)
+
+    def ready(self):
+        now = time.monotonic()
+        ready = []
+        for path, (changed, state) in list(self.pending.items()):
+            if now - changed < self.quiet:
+                continue
+            current = file_state(path)
+            if current != state:
+                # при опросе запись в файл могла не дать события - ждем еще
+                self.pending[path] = now, current
+                continue
+            del self.pending[path]
+            ready.append(path)
+        return ready
+
+
+class WatchDaemon:
+    def __init__(self, startdir=startdir, duplicates=None, polling=False):
+        self.startdir = startdir
+        self.index = InventoryIndex(duplicates) if duplicates else None
+        self.config = GpXlsConfig(startdir, recreate_tables=False, incremental=True)
+        self.cur, self.conn = open_db()
+        self.watcher = make_watcher(startdir, polling)
+        self.debouncer = Debouncer()
+
+    def reload_config(self):
+        """новые филиалы дописываются в gp_branches, поля перечитываются из fields.csv"""
+        logging.info('RELOADING CONFIG')
+        self.config = GpXlsConfig(self.startdir, recreate_tables=False, incremental=True)
+
+    def reconnect(self):
+        logging.warning('DB CONNECTION LOST, RECONNECTING')
+        try:
+            close_db(self.cur, self.conn)
+        except MySQLdb.Error:
+            pass
+        self.cur, self.conn = open_db()
+
+    def catch_up(self):
+        """то, что изменилось, пока демон не работал"""
+        filenames = get_filenames(self.startdir)
+        check_filename_collisions(filenames, self.config)
+        plan = plan_delta(filenames, get_manifest(self.cur), self.startdir)
+        print(f'Catching up: {len(plan.load)} files to load, {len(plan.remove)} to remove')
+        for file in plan.load:
+            load_file(file, self.config, self.cur, self.conn, index=self.index)
+        for row in plan.remove:
+            remove_file(row, self.cur, self.conn, self.index)
+
+    def is_watched(self, path):
+        if path == os.path.join(self.startdir, config_file):
+            return True
+        # файлы прямо в startdir ни к какому филиалу не относятся
+        return (os.path.dirname(path) != self.startdir and is_xls(os.path.basename(path))
+                and not_in_blacklist(path))
+
+    def handle(self, path):
+        if path == os.path.join(self.startdir, config_file):
+            self.reload_config()
+            return
+        t1 = time.time()
+        if os.path.exists(path):
+            if self.config.get_branch_name(path) not in self.config.branches_indexes:
+                self.reload_config()
+            rows = load_file(path, self.config, self.cur, self.conn, index=self.index)
+            print(f'{relative_path(path, self.startdir)}: {rows} rows loaded in {time.time() - t1:.1f} s')
+            return
+        self.cur.execute(f"""SELECT * FROM {bkf_manifest_table} WHERE bkm_path = %s""",
+                         (relative_path(path, self.startdir),))
+        row = self.cur.fetchone()
+        if row:
+            deleted = remove_file(row, self.cur, self.conn, self.index)
+            print(f'{row["bkm_path"]}: removed, {deleted} rows deleted')
+
+    def step(self):
+        self.debouncer.touch(path for path in self.watcher.changes() if self.is_watched(path))
+        ready = self.debouncer.ready()
+        for path in ready:
+            try:
+                try:
+                    self.handle(path)
+                except MySQLdb.OperationalError:
+                    self.reconnect()
+                    self.handle(path)
+            except Exception:
+                # файл остается со старыми строками; следующая запись в него снова вызовет загрузку
+                logging.exception(f'FAILED TO LOAD {path}')
+        if ready and self.index:
+            self.index.save()
+
+    def run(self):
+        self.catch_up()
+        print('Watching for changes, Ctrl+C to stop')
+        try:
+            while True:
+                self.step()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_db(self.cur, self.conn)
+            if self.index:
+                self.index.save()
+                self.index.show_stats()
+
+
+if __name__ == "__main__":
+    import sys
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    WatchDaemon(duplicates=options.get('duplicates'), polling='--poll' in sys.argv).run()
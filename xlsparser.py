@@ -1,27 +1,74 @@
+import hashlib
+import time
 import numpy as np
 import pandas as pd
-from pandas.errors import ParserError
 import os
 import logging
 from config import GpXlsConfig
+from layout import LayoutCache
+from metrics import get_metrics
+from reader import iter_row_chunks, pick_engine, read_raw
+
+# поля, пустые значения в которых заполняются значением из строки выше
+AUTOFILL_FIELDS = ['bkf_business_sphere', 'bkf_class_os_code']
+# сколько строк под строкой заголовка читаем вместе с шапкой при потоковом парсинге
+HEAD_TAIL_ROWS = 10
+# строковые столбцы, где уникальных значений не больше этой доли строк, храним как category
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def parse_decimal(series: pd.Series):
+    """превращает столбец строк в float. Сначала пробуем как есть (быстро на чистых столбцах),
+    а значения, которые не разобрались, чистим от пробелов (в т.ч. неразрывных),
+    запятую меняем на точку и пробуем еще раз. Пустые строки - NaN.
+    Возвращает числа и маску значений, которые так и не удалось разобрать"""
+    values = pd.to_numeric(series, errors='coerce')
+    failed = values.isnull() & series.notnull()
+    if failed.any():
+        cleaned = (series[failed].astype(str)
+                   .str.replace(r'[\s\xa0]+', '', regex=True)
+                   .str.replace(',', '.', regex=False))
+        cleaned = cleaned.where(cleaned != '')
+        values[failed] = pd.to_numeric(cleaned, errors='coerce')
+        failed &= cleaned.reindex(series.index).notnull() & values.isnull()
+    return values.astype(float), failed
 
 
 class GpXlsParser:
-    def __init__(self, file: str, config: GpXlsConfig):
+    def __init__(self, file: str, config: GpXlsConfig, layouts: LayoutCache = None):
         # приходится хранить у себя объект конфига, так как иногда нужно подменить
         # конфигурацию полей "на лету", поэтому свойства полей реализованы
         # через @property
         self.config_obj = config
         self.file = file  # full path
         self.filename = os.path.basename(file)
+        # номер строки заголовка в сырой таблице
         self.skip = 0
         # для записи номера строки в исходном файле нужна разность между номером строки в xls
-        # и индексом в датафрейме, 2 по умолчанию, так как нумерация в xls с 1,
-        # в пандас - с 0, плюс одна строка - шапка
-        self.delta = 2
+        # и индексом в датафрейме: индекс берем из сырой таблицы, так что разница всегда 1,
+        # так как нумерация в xls с 1, в пандас - с 0
+        self.delta = 1
+        self.raw = None
+        self.key_col = None
         self.df = None
+        # столбец, по пустым значениям которого выкидываем мусорные строки (см. _clear_df)
+        self.filter_field = None
+        # последние заполненные значения автозаполняемых полей, при потоковом парсинге
+        # переносятся из чанка в чанк
+        self.autofill_last = {}
+        # значения числовых полей, которые не удалось разобрать: {'row', 'field', 'value'}
+        self.type_errors = []
+        # значения, которые не помещаются в поля bkf или не разобрались (см. _validate_df):
+        # {'row', 'field', 'kind', 'value', 'limit'}
+        self.violations = []
+        self._checked_type_errors = 0
+        # кэш раскладок шапки, если не передан - шапка всегда ищется заново
+        self.layouts = layouts
+        self.metrics = get_metrics()
         self.config = config.get_config(self.file)
         self.branch_name = self.config['branch_name']
+        # движок чтения: самый быстрый для формата или заданный для филиала в config.READER_ENGINES
+        self.engine = pick_engine(self.file, self.config.get('reader_engine'))
         self.multirow = 0
 
     @property
@@ -42,87 +89,161 @@ class GpXlsParser:
     def mapper(self):
         return self.config['mapper']
 
-    def _findheader(self):
-        """находим заголовок (строка, содержащая поле с инвентарным номером) и считываем его
-        проблема: если документ начинается с нескольких пустых строк, то парсер xls считает их за одну,
-        соответственно, индекс найденного заголовка не будет совпадать с реальным
-        поэтому, вызываем функцию, смещаясь вниз, пока не получим нужное поле в заголовке датафрейма"""
-        print(f'Reading {self.file}...')
-        df = pd.read_excel(self.file, skiprows=self.skip, dtype=str)
-        logging.debug(f'COLS IN DF: {df.columns}')
-        # пропускаем шапку таблицы
-        if self.key_field in df.columns:
-            return df
+    def _stage(self, name, method):
+        """выполняет этап парсинга, при включенных метриках замеряет время и число строк"""
+        if not self.metrics.enabled:
+            return method()
+        rows_in = len(self.df) if self.df is not None else None
+        t1 = time.perf_counter()
+        result = method()
+        seconds = time.perf_counter() - t1
+        if isinstance(result, pd.DataFrame):
+            rows_out = len(result)
         else:
-            ix = 0
-            logging.info('SEARCHING HEADER')
-            for index, row in df.iterrows():
-                # ищем строчку с ключевым полем
-                # и считаем её шапкой таблицы
-                header = list(row)
-                logging.debug(f'{ix}, {header}')
-                if (self.key_field in header) or (self.key_field == index):
-                    logging.debug(f'CATCH {index} {header}')
-                    logging.debug(f'INDEX {ix+1} {ix == index}')
-                    self.skip += ix + 1
-                    break
-                ix += 1
-            logging.info('Re-reading...')
-            df = self._findheader()
-            return df
+            rows_out = len(self.df) if self.df is not None else None
+        self.metrics.stage(name, seconds, rows_in, rows_out)
+        return result
+
+    def _read_raw(self):
+        """считываем файл целиком один раз, без заголовка: дальше шапку ищем в памяти.
+        значения читаем строками (чтобы не испортить инвентарные номера и коды),
+        пустые ячейки - NaN, типы столбцов приводим потом по конфигу"""
+        print(f'Reading {self.file} with {self.engine}...')
+        return read_raw(self.file, self.engine)
+
+    def _findheader(self):
+        """находим заголовок (строка, содержащая поле с инвентарным номером)
+        индекс строки в сырой таблице совпадает с её номером в xls минус 1,
+        поэтому пустые строки в начале документа нам не мешают"""
+        logging.info('SEARCHING HEADER')
+        for index, row in self.raw.iterrows():
+            header = list(row)
+            if self.key_field in header:
+                logging.debug(f'CATCH {index} {header}')
+                self.key_col = header.index(self.key_field)
+                return index
+        raise ValueError(f'Unable to find header with key field {self.key_field!r} in {self.file}')
 
     def _find_multirow_header(self):
         """вычисляем количество строк в шапке, для этого смотрим
-        сколько в столбце ключевого поля значений NaN
+        сколько в столбце ключевого поля значений NaN под строкой заголовка
         поэтому ключевое поле:
         - должно быть во всех таблицах
         - должно занимать всегда одну строку
         - должно быть всегда заполнено.
         В одной таблице после шапки есть пустая строка, наш парсер считает её частью шапки,
-        и от этого pandas.read_excel падает с ошибкой. Поэтому если не удалось распарсить
-        файл с multirow = n, то пробуем это сделать с multirow = n-1
+        поэтому полностью пустые строки в конце шапки к ней не относим
         """
         logging.debug('MULTIROW')
+        key_column = self.raw[self.key_col].iloc[self.skip + 1:]
         logging.debug('FIRST 5 IN KEY FIELD')
-        logging.debug(f"\n{self.df[self.key_field][:5]}")
-        logging.debug(f"\n{self.df[self.key_field][:5]} == 'nan'")
+        logging.debug(f"\n{key_column[:5]}")
         count = 0
-        for i in self.df[self.key_field] == 'nan':
-            if not i: break
+        for i in key_column.isnull():
+            if not i:
+                break
             count += 1
+        while count and self.raw.loc[self.skip + count].isnull().all():
+            logging.debug('EMPTY ROW IN HEADER, cutting header')
+            count -= 1
         logging.info(f'MULTIROW COUNT: {count}')
         if count:
             logging.debug('MULTIROW found')
         return count
 
+    @staticmethod
+    def _fill_header_row(row, control_row):
+        """протягиваем вправо значения объединенных ячеек шапки,
+        но не дальше границ ячеек строкой выше (так же делает pandas для многострочной шапки)"""
+        row = list(row)
+        last = row[0]
+        for i in range(1, len(row)):
+            if not control_row[i]:
+                last = row[i]
+            if pd.isnull(row[i]):
+                row[i] = last
+            else:
+                control_row[i] = False
+                last = row[i]
+        return row, control_row
+
     def _rewrite_index(self):
-        """если шапка состоит из нескольких строк, переделываем индекс таблицы вручную.
-        генерируем свой индекс, затем парсим заново без индекса, приделывая свой.
+        """собираем имена столбцов из строк шапки: значения одного столбца склеиваем через перевод строки.
+        если шапка из одной строки - берем её как есть
         """
-        if self.multirow < 1:
-            raise ValueError('Unexpected value of multirow while cutting header')
-        header = [i for i in range(self.multirow + 1)]
-        logging.debug(f'HEADER: {header}')
-        try:
-            df = pd.read_excel(self.file, skiprows=self.skip, header=header, dtype=str)
-        except ParserError:
-            logging.debug('ERROR, trying cut header')
-            self.multirow -= 1
-            return self._rewrite_index()
+        header_rows = self.raw.loc[self.skip:self.skip + self.multirow]
+        if self.multirow:
+            control_row = [True] * header_rows.shape[1]
+            filled = []
+            for _, row in header_rows.iterrows():
+                row, control_row = self._fill_header_row(row, control_row)
+                filled.append(row)
+            names = ['\n'.join([j for j in column if not pd.isnull(j)]) for column in zip(*filled)]
+        else:
+            names = [j if not pd.isnull(j) else '' for j in header_rows.iloc[0]]
+        # пустые и повторяющиеся имена столбцов делаем уникальными, как pandas
         new_index = []
-        for i in df.columns:
-            new_index.append('\n'.join([j for j in i if 'Unnamed' not in j]))
-        # pandas в режиме multirow header принудительно создает из первой колонки индекс, поправляем
-        new_index = [df.columns.names[0], ] + new_index
+        seen = {}
+        for i, name in enumerate(names):
+            if not name:
+                name = f'Unnamed: {i}'
+            if name in seen:
+                seen[name] += 1
+                name = f'{name}.{seen[name]}'
+            else:
+                seen[name] = 0
+            new_index.append(name)
         logging.debug('CREATING NEW INDEX')
         logging.debug(new_index)
-        self.skip += len(header)
-        # корректируем смещение, так как пропускаем исходную шапку
-        self.delta -= 1
-        # заново парсим файл, уже без шапки, припиливаем к нему свою сгенерированную ранее
-        df = pd.read_excel(self.file, skiprows=self.skip, index_col=None, header=None, dtype=str, names=new_index)
+        df = self.raw.loc[self.skip + self.multirow + 1:].copy()
+        df.columns = new_index
         return df
 
+    def _header_digest(self, skip, multirow):
+        """хэш строк шапки - по нему проверяем, что сохраненная раскладка подходит к файлу"""
+        rows = self.raw.loc[skip:skip + multirow]
+        return hashlib.sha1(rows.to_csv(header=False, index=False).encode('utf-8')).hexdigest()
+
+    def _apply_layout(self):
+        """пробуем сохраненные раскладки филиала: если строки шапки на том же месте совпадают,
+        берем заголовок, число строк шапки и конфигурацию полей без поиска"""
+        for layout in self.layouts.get(self.branch_name):
+            if layout['skip'] + layout['multirow'] >= len(self.raw):
+                continue
+            if self._header_digest(layout['skip'], layout['multirow']) != layout['digest']:
+                continue
+            logging.info('HEADER LAYOUT FOUND IN CACHE')
+            self.skip, self.multirow, self.key_col = layout['skip'], layout['multirow'], layout['key_col']
+            if layout['is_alter']:
+                self.config = self.config_obj.get_alter_config(self.file)
+            self.df = self._rewrite_index()
+            self.layouts.hits += 1
+            return True
+        self.layouts.misses += 1
+        return False
+
+    def _detect_header(self):
+        """находим шапку и собираем по ней столбцы датафрейма, проверяем, что все поля найдены.
+        если есть кэш раскладок - сначала пробуем его, найденную раскладку сохраняем"""
+        if self.layouts is not None and self._apply_layout():
+            self._mapped()
+            return
+        self.skip = self._findheader()
+        # определяем заголовок из нескольких строк, если он есть
+        self.multirow = self._find_multirow_header()
+        # собираем имена столбцов из шапки и отрезаем её
+        self.df = self._rewrite_index()
+        # проверяем, все ли поля найдены
+        self._mapped()
+        if self.layouts is not None:
+            self.layouts.add(self.branch_name, {
+                'skip': int(self.skip),
+                'multirow': self.multirow,
+                'key_col': int(self.key_col),
+                'is_alter': self.config['is_alter'],
+                'digest': self._header_digest(self.skip, self.multirow),
+            })
+
     def _mapped(self):
         """
         для логирования: пишем поля, которые не смапились
@@ -157,10 +278,10 @@ class GpXlsParser:
         # удаляем ее и все строки выше
         # начинаем с пятой строки, просто потому что файлов с бОльшим количеством
         # служебных строк нет
-        for row in range(5, -1, -1):
-            if all([i.isdigit() for i in self.df.loc[row] if type(i) == str]):
+        for row in range(min(5, len(self.df) - 1), -1, -1):
+            if all([isinstance(i, str) and i.isdigit() for i in self.df.iloc[row]]):
                 logging.info(f'Skipping first {row+1} strings...')
-                self.df = self.df.drop([j for j in range(row + 1)])
+                self.df = self.df.drop(self.df.index[:row + 1])
                 break
 
     def _clear_df(self):
@@ -168,56 +289,156 @@ class GpXlsParser:
          это либо инвентарный номер, либо наименование, потому что то там, то там
          попадаются слова типа Итого, в зависимости от файла.
          на данный момент потери всего три элемента (в одной таблице фильтруем по имени,
-         а там у трех элементов нет имени)"""
-        key_drop_rows_count = self.df[self.df[self.key_field] == 'nan'].shape[0]
-        name_drop_rows_count = self.df[self.df[self.name_field] == 'nan'].shape[0]
-        if key_drop_rows_count == 0 and name_drop_rows_count == 0:
-            count = 0
-        elif key_drop_rows_count >= name_drop_rows_count:
-            self.df = self.df[self.df[self.key_field] != 'nan']
-            count = key_drop_rows_count
-        else:
-            self.df = self.df[self.df[self.name_field] != 'nan']
-            count = name_drop_rows_count
+         а там у трех элементов нет имени).
+         При потоковом парсинге столбец выбирается по первому чанку, где есть мусор."""
+        if self.filter_field is None:
+            key_drop_rows_count = self.df[self.key_field].isnull().sum()
+            name_drop_rows_count = self.df[self.name_field].isnull().sum()
+            if key_drop_rows_count == 0 and name_drop_rows_count == 0:
+                logging.info("0 TRASH ROWS WAS DROPPED")
+                return
+            elif key_drop_rows_count >= name_drop_rows_count:
+                self.filter_field = self.key_field
+            else:
+                self.filter_field = self.name_field
+        trash = self.df[self.filter_field].isnull()
+        count = trash.sum()
+        self.df = self.df[~trash]
         logging.info(f"{count} TRASH ROWS WAS DROPPED")
 
+    def _type_errors(self, field, bad, kind):
+        """записываем значения, которые не удалось привести к типу поля"""
+        if bad.any():
+            errors = [{'row': row, 'field': self.mapper[field], 'value': value}
+                      for row, value in self.df[field][bad].items()]
+            logging.warning(f"{len(errors)} BAD {kind} VALUES IN {self.mapper[field]} "
+                            f"(rows {[e['row'] for e in errors[:10]]}...) SET TO NULL")
+            self.type_errors += errors
+
     def _init_df_types(self):
-        """на данном этапе все поля в датафрейме - str, а значения NaN - 'nan'
-        делаем из 'nan' настоящее а из str - float"""
-        self.df = self.df.replace('nan', np.nan)
-        logging.debug(f"DECIMAL: {self.config['decimal_fields']}")
-        for field in self.config['decimal_fields']:
-            try:
-                self.df[field] = self.df[field].astype(float)
-            except ValueError as e:
-                logging.info(f"Value Error on {field}: {e}")
-                logging.info("Replacing ',' and ' '")
-                self.df[field] = self.df[field].str.replace(' ', '')
-                self.df[field] = self.df[field].str.replace(',', '.')
-                self.df[field] = self.df[field].astype(float)
-            finally:
-                # на некоторых значениях вылезал MySQL Warning 1265, "Data truncated for column
-                # так как числа хранились иногда в виде "338394.51999999996",
-                # который в два десятичных разряда не помещается. Округляем.
-                self.df[field] = self.df[field].round(2)
+        """на данном этапе все поля в датафрейме - str, пустые - NaN.
+        decimal поля делаем float64, целые - Int64 (с поддержкой пропусков).
+        Значения, которые не удалось превратить в число, становятся NULL
+        и записываются в self.type_errors с номером строки в xls"""
+        decimal_fields = [f for f in self.config['decimal_fields'] if f in self.df.columns]
+        int_fields = [f for f in self.config.get('int_fields', []) if f in self.df.columns]
+        logging.debug(f"DECIMAL: {decimal_fields}")
+        for field in decimal_fields:
+            values, bad = parse_decimal(self.df[field])
+            self._type_errors(field, bad, 'DECIMAL')
+            # на некоторых значениях вылезал MySQL Warning 1265, "Data truncated for column
+            # так как числа хранились иногда в виде "338394.51999999996",
+            # который в два десятичных разряда не помещается. Округляем.
+            self.df[field] = values.round(2)
+        for field in int_fields:
+            values, bad = parse_decimal(self.df[field])
+            fractional = values.notnull() & (values != values.round())
+            self._type_errors(field, bad | fractional, 'INT')
+            self.df[field] = values.where(~fractional).astype('Int64')
+
+    def _violation_mask(self, field, limit):
+        """маска значений столбца, не помещающихся в поле (limit - см. config.column_limit)"""
+        column = self.df[field]
+        kind = limit[0]
+        if kind == 'str':
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # длины считаем по категориям, а не по каждой ячейке
+                lengths = column.cat.categories.astype(str).str.len()
+                too_long = np.append(np.asarray(lengths) > limit[1], False)
+                return pd.Series(too_long[column.cat.codes], index=column.index), 'too_long'
+            return (column.str.len() > limit[1]).fillna(False).astype(bool), 'too_long'
+        if not pd.api.types.is_numeric_dtype(column.dtype):
+            return None, None
+        if kind == 'decimal':
+            return (column.round(limit[2]).abs() >= limit[1]).fillna(False).astype(bool), 'decimal_overflow'
+        return ((column < limit[1]) | (column > limit[2])).fillna(False).astype(bool), 'int_overflow'
+
+    def _validate_df(self):
+        """проверяем все поля по ширине и точности из TYPE в fields.csv до отправки в БД,
+        чтобы не ловить предупреждения MySQL по одному на executemany.
+        Нарушения записываются в self.violations с номером строки в xls, дальше - по политике конфига:
+        truncate - строки обрезаются (числа - NULL), null - NULL, reject - строка не загружается.
+        Неразобранные числа (self.type_errors) уже стали NULL, при reject их строки тоже выкидываются"""
+        policy = self.config_obj.validation_policy
+        limits = self.config_obj.limits
+        reject = pd.Series(False, index=self.df.index)
+        errors_start = len(self.violations)
+        for error in self.type_errors[self._checked_type_errors:]:
+            self.violations.append({'row': error['row'], 'field': error['field'], 'kind': 'invalid',
+                                    'value': error['value'], 'limit': None})
+            if error['row'] in reject.index:
+                reject[error['row']] = True
+        self._checked_type_errors = len(self.type_errors)
+        for field in self.df.columns:
+            if field not in limits:
+                continue
+            limit = limits[field]
+            bad, kind = self._violation_mask(field, limit)
+            if bad is None or not bad.any():
+                continue
+            column = self.df[field]
+            self.violations += [{'row': row, 'field': field, 'kind': kind, 'value': value, 'limit': limit[1:]}
+                                for row, value in column[bad].items()]
+            logging.warning(f"{bad.sum()} VALUES IN {field} DO NOT FIT {self.config_obj.fields['TYPE'][field]} "
+                            f"(rows {list(column.index[bad][:10])}...), POLICY {policy.upper()}")
+            if policy == 'reject':
+                reject |= bad
+            elif policy == 'truncate' and kind == 'too_long':
+                truncated = column.astype(object).where(~bad, column.astype(str).str.slice(0, limit[1]))
+                is_category = isinstance(column.dtype, pd.CategoricalDtype)
+                self.df[field] = truncated.astype('category') if is_category else truncated
+            else:
+                self.df[field] = column.where(~bad)
+        if policy == 'reject' and reject.any():
+            logging.warning(f'{reject.sum()} ROWS REJECTED')
+            self.df = self.df[~reject]
+        if len(self.violations) > errors_start:
+            self.show_violations(self.violations[errors_start:])
+
+    def show_violations(self, violations=None):
+        violations = self.violations if violations is None else violations
+        if violations:
+            print()
+            print('*' * 100)
+            print(f'{len(violations)} VALUES IN {self.filename} DO NOT FIT BKF FIELDS '
+                  f'(policy {self.config_obj.validation_policy}):')
+            for v in violations:
+                print(v)
+            print('*' * 100)
+            print()
+
+    def _compact_df_types(self):
+        """строковые столбцы с небольшим числом разных значений (коды классов, сферы деятельности)
+        храним как category - это в разы меньше памяти, чем str на каждую ячейку"""
+        numeric = set(self.config['decimal_fields']) | set(self.config.get('int_fields', []))
+        for field in self.df.columns:
+            if field in numeric or not len(self.df):
+                continue
+            column = self.df[field]
+            if column.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(column):
+                self.df[field] = column.astype('category')
 
     def _set_index(self):
         """делаем так, чтобы index совпадал с номерами строк в xls"""
-        # устанавливаем delta
-        self.delta += self.skip
         logging.debug(f'DELTA {self.delta}')
         self.df.index += self.delta
 
     def _df_autofill(self):
         """автозаполняем некоторые поля, если это необходимо"""
-        for field in ['bkf_business_sphere', 'bkf_class_os_code']:
+        for field in AUTOFILL_FIELDS:
             if field in self.fields:
                 df_field = self.fields[field]
                 nans_count = self.df[df_field].isnull().sum()
                 if nans_count:
                     log = f"FILLING {nans_count} NaN's in {field}"
                     logging.info(log)
-                    self.df[df_field] = self.df[df_field].fillna(method='ffill')
+                    self.df[df_field] = self.df[df_field].ffill()
+                    if field in self.autofill_last:
+                        # начало чанка заполняем последним значением из предыдущего
+                        self.df[df_field] = self.df[df_field].fillna(self.autofill_last[field])
+                filled = self.df[df_field].dropna()
+                if len(filled):
+                    self.autofill_last[field] = filled.iloc[-1]
 
     def _mapped_df(self):
         """Оставляем только те поля, которые будут в нашей таблице"""
@@ -227,30 +448,83 @@ class GpXlsParser:
     def _add_service_fields(self):
         """делаем поля с номером строки, именем файла и названием филиала"""
         self.df['bkf_row_num'] = self.df.index
-        self.df['bkf_branch_id'] = self.config['branch_id']
-        self.df['bkf_filename'] = self.filename
+        self.df['bkf_branch_id'] = np.int32(self.config['branch_id'])
+        self.df['bkf_filename'] = pd.Categorical.from_codes(np.zeros(len(self.df), dtype=np.int8),
+                                                            categories=[self.filename])
         self.df.name = self.config['branch_name']
 
     def parse(self):
         print('Parsing {}...'.format(self.filename))
-        self.df = self._findheader()
-        # определяем заголовок из нескольких строк, если он есть
-        self.multirow = self._find_multirow_header()
-        # если индекс многострочный - переписываем его
-        if self.multirow:
-            self.df = self._rewrite_index()
-        # проверяем, все ли поля найдены
-        self._mapped()
-        # удаляем нумерацию столбцов и прочий мусор в шапке
-        self._check_first_string()
-        # вычищаем мусор из датафрейма
-        self._clear_df()
-        # делаем так, чтобы index совпадал с номерами строк в xls
-        self._set_index()
+        with self.metrics.file(self.file):
+            # файл читаем один раз, все остальное делаем в памяти
+            self.raw = self._stage('read', self._read_raw)
+            # находим шапку, отрезаем её и проверяем, все ли поля найдены
+            self._stage('header', self._detect_header)
+            self.raw = None
+            # удаляем нумерацию столбцов и прочий мусор в шапке
+            self._stage('first_string', self._check_first_string)
+            # вычищаем мусор из датафрейма
+            self._stage('clear', self._clear_df)
+            # делаем так, чтобы index совпадал с номерами строк в xls
+            self._stage('set_index', self._set_index)
+            self._process_df()
+        return self.df
+
+    def _process_df(self):
         # приводим нужные типы данных
-        self._init_df_types()
+        self._stage('types', self._init_df_types)
         # автозаполняем некоторые поля, если это необходимо
-        self._df_autofill()
-        self._mapped_df()
-        self._add_service_fields()
+        self._stage('autofill', self._df_autofill)
+        # строки с повторяющимися значениями делаем категориями
+        self._stage('compact', self._compact_df_types)
+        self._stage('map', self._mapped_df)
+        # проверяем поля по ширине и точности из fields.csv
+        self._stage('validate', self._validate_df)
+        self._stage('service_fields', self._add_service_fields)
+
+    def _process_chunk(self, rows, offset, columns):
+        """прогоняет кусок строк под шапкой через очистку, приведение типов и маппинг"""
+        self.df = pd.DataFrame(rows, index=range(offset, offset + len(rows)))
+        self.df = self.df.reindex(columns=range(len(columns)))
+        self.df.columns = columns
+        self._stage('clear', self._clear_df)
+        self._stage('set_index', self._set_index)
+        self._process_df()
         return self.df
+
+    def parse_chunks(self, chunk_size=10000):
+        """потоковый парсинг: файл читается кусками по chunk_size строк, и каждый кусок
+        отдается готовым к загрузке, пока следующий еще не прочитан.
+        Шапка ищется в первых прочитанных строках (пока не найдется ключевое поле),
+        дальше в памяти держится только текущий кусок."""
+        print('Parsing {} by chunks...'.format(self.filename))
+        with self.metrics.file(self.file):
+            yield from self._parse_chunks(chunk_size)
+
+    def _parse_chunks(self, chunk_size):
+        chunks = iter_row_chunks(self.file, chunk_size, self.engine)
+        t1 = time.perf_counter()
+        head = []
+        header_ix = None
+        for chunk in chunks:
+            head += chunk
+            if header_ix is None:
+                header_ix = next((i for i, row in enumerate(head) if self.key_field in row), None)
+            # под шапкой должны поместиться её нижние строки и нумерация столбцов
+            if header_ix is not None and len(head) > header_ix + HEAD_TAIL_ROWS:
+                break
+        self.raw = pd.DataFrame(head)
+        if self.metrics.enabled:
+            self.metrics.stage('read', time.perf_counter() - t1, None, len(head))
+        self._stage('header', self._detect_header)
+        self.raw = None
+        columns = list(self.df.columns)
+        # шапка и нумерация столбцов всегда лежат в первом куске
+        self._stage('first_string', self._check_first_string)
+        first = self.df
+        if len(first):
+            yield self._process_chunk(first.values.tolist(), first.index[0], columns)
+        offset = len(head)
+        for chunk in chunks:
+            yield self._process_chunk(chunk, offset, columns)
+            offset += len(chunk)